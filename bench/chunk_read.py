@@ -0,0 +1,79 @@
+# Compares bytes copied per uploaded GiB by the old `buf += data` chunk assembly and chunk_buffer.ChunkReader
+# usage: python3 bench/chunk_read.py [pipe read size in KiB]
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from chunk_buffer import ChunkReader
+
+TOTAL = 1024 * 1024 * 1024
+CHUNK = 512 * 1024
+
+
+class Source:
+    # returns no more than pipe buffer per read like ffmpeg stdout
+    def __init__(self, pipe_size):
+        self.pipe_size = pipe_size
+        self.left = TOTAL
+        self.block = os.urandom(pipe_size)
+
+    async def read(self, n):
+        n = min(n, self.pipe_size, self.left)
+        self.left -= n
+        return self.block[:n]
+
+
+class LegacyReader:
+    def __init__(self, source):
+        self.source = source
+        self._buf = b''
+        self.copied = 0
+
+    async def read(self, n):
+        buf = b''
+        if len(self._buf) != 0:
+            buf += self._buf
+            self.copied += len(buf)
+            self._buf = b''
+        while len(buf) < n:
+            _data = await self.source.read(n)
+            if len(_data) == 0:
+                break
+            buf += _data
+            self.copied += len(buf)
+        if len(buf) > n:
+            self._buf = buf[n:]
+            self.copied += len(buf)
+            return buf[:n]
+        return buf
+
+
+async def run(name, reader, read):
+    started = time.monotonic()
+    total = 0
+    while True:
+        chunk = await read(reader)
+        if not chunk:
+            break
+        total += len(chunk)
+    print('{:>10}: {:.2f} GiB copied per GiB, {:.2f}s'.format(name, reader.copied / total, time.monotonic() - started))
+
+
+async def main(pipe_size):
+    await run('legacy', LegacyReader(Source(pipe_size)), lambda r: r.read(CHUNK))
+    source = Source(pipe_size)
+    await run('read', ChunkReader(source.read), lambda r: r.read(CHUNK))
+    source = Source(pipe_size)
+    buf = bytearray(CHUNK)
+
+    async def readinto(r):
+        n = await r.readinto(buf)
+        return memoryview(buf)[:n]
+    await run('readinto', ChunkReader(source.read), readinto)
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main(int(sys.argv[1]) * 1024 if len(sys.argv) > 1 else 64 * 1024))
@@ -0,0 +1,40 @@
+# Compares HLS playlist size probing: one sequential request per segment against av_utils.m3u8_video_size
+# usage: python3 bench/m3u8_probe.py <m3u8 url>
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import m3u8
+from aiohttp import ClientSession, TCPConnector
+import av_utils
+import http_pool
+
+
+async def sequential_size(url):
+    async with ClientSession(connector=TCPConnector(verify_ssl=False)) as session:
+        async with session.get(url) as resp:
+            m3u8_obj = m3u8.loads((await resp.read()).decode())
+            m3u8_obj.base_uri = av_utils.m3u8_parse_url(str(resp.url))
+        size = 0
+        for seg in m3u8_obj.segments:
+            size += await av_utils.media_size(seg.absolute_uri, session=session)
+    return size, len(m3u8_obj.segments)
+
+
+async def main(url):
+    started = time.monotonic()
+    size, segments = await sequential_size(url)
+    print('sequential: {} bytes, {} segments, {:.2f}s'.format(size, segments, time.monotonic() - started))
+
+    started = time.monotonic()
+    size = await av_utils.m3u8_video_size(url)
+    print('concurrent: {} bytes, {:.2f}s'.format(size, time.monotonic() - started))
+    print(av_utils.m3u8_probe_stats)
+    await http_pool.close()
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main(sys.argv[1]))
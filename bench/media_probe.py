@@ -0,0 +1,79 @@
+# Compares latency and bytes fetched by media_probe header parsing and ffprobe subprocess
+# usage: python3 bench/media_probe.py <media file>...
+import asyncio
+import os
+import re
+import shutil
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from aiohttp import web
+import av_utils
+import http_pool
+import media_probe
+
+PORT = 18790
+served = {'bytes': 0}
+
+
+async def serve_file(request):
+    # local range server counting sent bytes, ffprobe reads files over http like real media
+    path = request.app['files'][request.match_info['name']]
+    size = os.path.getsize(path)
+    match = re.match(r'bytes=(\d+)-(\d*)', request.headers.get('Range', ''))
+    start, end, status = 0, size - 1, 200
+    if match:
+        start = int(match.group(1))
+        end = min(int(match.group(2) or size - 1), size - 1)
+        status = 206
+    resp = web.StreamResponse(status=status, headers={'Content-Length': str(end - start + 1),
+                                                      'Content-Range': 'bytes {}-{}/{}'.format(start, end, size),
+                                                      'Accept-Ranges': 'bytes'})
+    await resp.prepare(request)
+    with open(path, 'rb') as f:
+        f.seek(start)
+        left = end - start + 1
+        try:
+            while left > 0:
+                chunk = f.read(min(left, 64 * 1024))
+                await resp.write(chunk)
+                served['bytes'] += len(chunk)
+                left -= len(chunk)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+    return resp
+
+
+async def measure(name, probe, url):
+    served['bytes'] = 0
+    started = time.monotonic()
+    info = await probe(url)
+    elapsed = time.monotonic() - started
+    # let server notice closed connections
+    await asyncio.sleep(0.2)
+    fmt = (info or {}).get('format', {})
+    print('  {:>8}: {:7.3f}s {:>10} bytes  duration={} streams={}'.format(
+        name, elapsed, served['bytes'], fmt.get('duration'), len((info or {}).get('streams', []))))
+
+
+async def main(paths):
+    app = web.Application()
+    app['files'] = {str(i) + os.path.splitext(p)[1]: p for i, p in enumerate(paths)}
+    app.add_routes([web.get('/{name}', serve_file)])
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', PORT).start()
+    for name, path in app['files'].items():
+        url = 'http://127.0.0.1:{}/{}'.format(PORT, name)
+        print('{} ({} bytes)'.format(path, os.path.getsize(path)))
+        await measure('header', media_probe.probe, url)
+        if shutil.which('ffprobe'):
+            await measure('ffprobe', av_utils._av_info, url)
+    await http_pool.close()
+    await runner.cleanup()
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main(sys.argv[1:]))
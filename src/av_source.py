@@ -1,15 +1,40 @@
 import typing
 import ffmpeg
 import asyncio
-from aiohttp import ClientSession, ClientTimeout, TCPConnector
+from aiohttp import ClientError, ClientTimeout
 import cut_time
 import av_utils
+import http_pool
+from chunk_buffer import ChunkReader
 from datetime import datetime
 import time
 import os
 import signal
 
 
+# parallel range requests per media url, 0 or 1 disables ranged downloading
+URL_RANGE_CONNECTIONS = int(os.getenv('URL_RANGE_CONNECTIONS', 0))
+URL_RANGE_CHUNK = int(os.getenv('URL_RANGE_CHUNK', 4)) * 1024 * 1024
+URL_RANGE_TIMEOUT = int(os.getenv('URL_RANGE_TIMEOUT', 600))
+
+# reconnects after dropped connection of media url
+URL_RESUME_RETRIES = int(os.getenv('URL_RESUME_RETRIES', 5))
+URL_RESUME_BACKOFF = float(os.getenv('URL_RESUME_BACKOFF', 1))
+
+resume_stats = {
+    'resumes': 0,
+    'failed': 0,
+    'saved_bytes': 0
+}
+
+ranged_stats = {
+    'ranged': 0,
+    'single': 0,
+    'chunks': 0,
+    'bytes': 0
+}
+
+
 class DumbReader(typing.BinaryIO):
     def write(self, s: typing.Union[bytes, bytearray]) -> int:
         pass
@@ -75,7 +100,7 @@ class DumbReader(typing.BinaryIO):
 class FFMpegAV(DumbReader):
 
     def __init__(self):
-        self._buf = b''
+        self._chunks = ChunkReader(self._read_some)
         self.file_name = None
 
     @staticmethod
@@ -231,24 +256,16 @@ class FFMpegAV(DumbReader):
 
         return ff
 
+    def _read_some(self, n):
+        return self.stream.stdout.read(n)
+
     async def read(self, n: int = -1):
-        buf = b''
-        if len(self._buf) != 0:
-            buf += self._buf
-            self._buf = b''
         if n == -1:
             return await self.stream.stdout.read()
+        return await self._chunks.read(n)
 
-        while len(buf) < n:
-            _data = await self.stream.stdout.read(n)
-            if len(_data) == 0:
-                break
-            buf += _data
-        if len(buf) > n != -1:
-            self._buf = buf[n:]
-            return buf[:n]
-        else:
-            return buf
+    async def readinto(self, buf) -> int:
+        return await self._chunks.readinto(buf)
 
     def close(self) -> None:
         # print('last data ', len(self.stream.stdout.read()))
@@ -280,9 +297,14 @@ class FFMpegAV(DumbReader):
             return b
 
 
+def resume_delay(attempt):
+    return min(URL_RESUME_BACKOFF * 2 ** attempt, 30)
+
+
 class URLav(DumbReader):
     def __init__(self):
-        self._buf = b''
+        self._chunks = ChunkReader(self._read_some)
+        self._offset = 0
 
     @staticmethod
     async def create(url, headers=None):
@@ -290,41 +312,91 @@ class URLav(DumbReader):
         if urlav.request.status != 200:
             await urlav.close()
             urlav = await URLav._create(url)
+        if URL_RANGE_CONNECTIONS > 1:
+            return RangedURLav.from_urlav(urlav)
         return urlav
 
 
     @staticmethod
     async def _create(url, headers=None):
         u = URLav()
+        u.headers = headers
         timeout = ClientTimeout(total=3600)
-        u.session = await ClientSession(timeout=timeout, connector=TCPConnector(verify_ssl=False)).__aenter__()
-        u.request = await u.session.get(url, headers=headers)
+        u.request = await http_pool.stream_session().get(url, headers=headers, timeout=timeout)
         # u.request = await asks.get(url, headers=headers, stream=True, max_redirects=5)
         # u.body = u.request.body(timeout=14400)
+        u.url = u.request.url
+        u.length = u.request.content_length if u.request.status == 200 else None
+        # weak etags can't be used in If-Range
+        etag = u.request.headers.get('ETag')
+        u.validator = etag if etag and not etag.startswith('W/') else u.request.headers.get('Last-Modified')
         return u
 
+    def _resumable(self):
+        return self.length is not None and self.request.headers.get('Accept-Ranges', '').lower() != 'none'
+
+    def resumable(self, file_size):
+        # download can be continued from any offset of the same media after restart
+        return self.length == file_size and self.validator is not None and self._resumable()
+
+    async def resume_at(self, offset):
+        previous, self._offset = self._offset, offset
+        try:
+            await self._resume()
+        except BaseException:
+            self._offset = previous
+            raise
+
+    async def _resume(self):
+        # continues download from current offset, fails if media was changed
+        headers = dict(self.headers or {})
+        headers['Range'] = 'bytes={}-'.format(self._offset)
+        if self.validator:
+            headers['If-Range'] = self.validator
+        resp = await http_pool.stream_session().get(self.url, headers=headers, timeout=ClientTimeout(total=3600))
+        content_range = resp.headers.get('Content-Range', '')
+        if resp.status != 206 or not content_range.startswith('bytes {}-'.format(self._offset)) or \
+                not content_range.endswith('/' + str(self.length)):
+            await resp.release()
+            raise Exception('Failed to resume media download, status ' + str(resp.status))
+        await self.request.release()
+        self.request = resp
+        resume_stats['resumes'] += 1
+        resume_stats['saved_bytes'] += self._offset
+
+    async def _read_some(self, n):
+        attempt = 0
+        while True:
+            try:
+                data = await self.request.content.read(n)
+                if data or self.length is None or self._offset >= self.length:
+                    self._offset += len(data)
+                    return data
+                error = Exception('Connection closed at {} of {} bytes'.format(self._offset, self.length))
+            except (ClientError, asyncio.TimeoutError) as e:
+                error = e
+            if not self._resumable() or attempt >= URL_RESUME_RETRIES:
+                resume_stats['failed'] += 1
+                raise error
+            await asyncio.sleep(resume_delay(attempt))
+            attempt += 1
+            try:
+                await self._resume()
+            except (ClientError, asyncio.TimeoutError):
+                # connection is retried on next read attempt
+                pass
+
     async def read(self, n: int = -1):
-        buf = b''
-        if len(self._buf) != 0:
-            buf += self._buf
-            self._buf = b''
         if n == -1:
             return await self.request.read()
+        return await self._chunks.read(n)
 
-        while len(buf) < n:
-            _data = await self.request.content.read(n)
-            if len(_data) == 0:
-                break
-            buf += _data
-        if len(buf) > n != -1:
-            self._buf = buf[n:]
-            return buf[:n]
-        else:
-            return buf
+    async def readinto(self, buf) -> int:
+        return await self._chunks.readinto(buf)
 
     async def close(self) -> None:
-        # self.request.release()
-        await self.session.__aexit__(exc_type=None, exc_val=None, exc_tb=None)
+        # connection is closed instead of returning to the pool if body wasn't read to the end
+        await self.request.release()
 
     def __aiter__(self):
         return self
@@ -337,6 +409,129 @@ class URLav(DumbReader):
             return b
 
 
+class RangedURLav(URLav):
+    # downloads ranges of media over several connections and hands them out in order,
+    # helps with CDNs limiting speed of single connection
+    def __init__(self, urlav, length):
+        super().__init__()
+        self.request = urlav.request
+        self.headers = urlav.headers
+        self.url = urlav.url
+        self.validator = urlav.validator
+        self.length = length
+        self.connections = URL_RANGE_CONNECTIONS
+        self.chunk_size = URL_RANGE_CHUNK
+        self.chunks_count = (length + self.chunk_size - 1) // self.chunk_size
+        # fetched chunks waiting for their turn and chunks being fetched, bounded by connections count
+        self._fetching = {}
+        self._next_fetch = 0
+        self._next_chunk = 0
+        self._current = b''
+        self._pos = 0
+        self._consumed = 0
+        # bytes of first chunk skipped after resume
+        self._skip = 0
+        self._initial_response = True
+
+    @staticmethod
+    def from_urlav(urlav):
+        resp = urlav.request
+        length = resp.content_length
+        if resp.status != 200 or resp.headers.get('Accept-Ranges', '').lower() != 'bytes' or \
+                length is None or length <= URL_RANGE_CHUNK:
+            ranged_stats['single'] += 1
+            return urlav
+        ranged_stats['ranged'] += 1
+        return RangedURLav(urlav, length)
+
+    def _schedule(self):
+        loop = asyncio.get_event_loop()
+        while self._next_fetch < self.chunks_count and self._next_fetch < self._next_chunk + self.connections:
+            self._fetching[self._next_fetch] = loop.create_task(self._fetch(self._next_fetch))
+            self._next_fetch += 1
+
+    async def _fetch_range(self, start, end):
+        headers = dict(self.headers or {})
+        headers['Range'] = 'bytes={}-{}'.format(start, end)
+        if self.validator:
+            headers['If-Range'] = self.validator
+        async with http_pool.stream_session().get(self.url, headers=headers,
+                                                  timeout=ClientTimeout(total=URL_RANGE_TIMEOUT)) as resp:
+            if resp.status != 206:
+                raise Exception('Range request failed with status ' + str(resp.status))
+            return await resp.read()
+
+    async def _fetch(self, index):
+        start = index * self.chunk_size
+        end = min(start + self.chunk_size, self.length) - 1
+        attempt = 0
+        while True:
+            try:
+                if index == 0 and attempt == 0 and self._initial_response:
+                    # first chunk is taken from already opened response
+                    try:
+                        data = await self.request.content.readexactly(end + 1)
+                    except asyncio.IncompleteReadError as e:
+                        raise ClientError(str(e))
+                    finally:
+                        await self.request.release()
+                else:
+                    data = await self._fetch_range(start, end)
+                if len(data) != end - start + 1:
+                    raise ClientError('Range request returned {} bytes instead of {}'.format(len(data),
+                                                                                        end - start + 1))
+                break
+            except (ClientError, asyncio.TimeoutError):
+                if attempt >= URL_RESUME_RETRIES:
+                    resume_stats['failed'] += 1
+                    raise
+            await asyncio.sleep(resume_delay(attempt))
+            attempt += 1
+            resume_stats['resumes'] += 1
+        ranged_stats['chunks'] += 1
+        ranged_stats['bytes'] += len(data)
+        return data
+
+    async def _read_some(self, n):
+        if self._pos >= len(self._current):
+            if self._next_chunk >= self.chunks_count:
+                return b''
+            self._schedule()
+            fetching = self._fetching.pop(self._next_chunk)
+            self._current = await fetching
+            self._pos = self._skip
+            self._skip = 0
+            self._next_chunk += 1
+            self._schedule()
+        data = self._current[self._pos:self._pos + n]
+        self._pos += len(data)
+        self._consumed += len(data)
+        if self._pos >= len(self._current):
+            self._current = b''
+            self._pos = 0
+        return data
+
+    async def read(self, n: int = -1):
+        if n == -1:
+            n = self.length - self._consumed
+        return await self._chunks.read(n)
+
+    async def resume_at(self, offset):
+        # ranges are validated by If-Range when they are fetched
+        index = offset // self.chunk_size
+        self._initial_response = False
+        await self.request.release()
+        self._next_chunk = self._next_fetch = index
+        self._skip = offset - index * self.chunk_size
+        self._consumed = offset
+
+    async def close(self) -> None:
+        for f in self._fetching.values():
+            f.cancel()
+        self._fetching.clear()
+        await self.request.release()
+
+
 async def video_screenshot(url, headers=None, screen_time=None, quality=5):
     image_data = await _video_screenshot(url, headers, screen_time=screen_time, quality=quality)
     if len(image_data) == 0:
@@ -1,10 +1,42 @@
 import m3u8
 import asyncio
+import copy
 import json
 import os, signal
-from aiohttp import ClientSession, hdrs, TCPConnector
+import time
+from aiohttp import hdrs
 from http.client import responses
 from urllib.parse import urlparse
+import http_pool
+import media_probe
+from cache import TTLCache
+
+
+M3U8_PROBE_CONCURRENCY = int(os.getenv('M3U8_PROBE_CONCURRENCY', 16))
+# playlists with more segments are probed partially
+M3U8_SAMPLE_SEGMENTS = int(os.getenv('M3U8_SAMPLE_SEGMENTS', 48))
+# estimated playlist size is increased by this percent, so real size doesn't exceed checked limits
+M3U8_ESTIMATE_MARGIN = float(os.getenv('M3U8_ESTIMATE_MARGIN', 10))
+
+AV_INFO_CACHE_SIZE = int(os.getenv('AV_INFO_CACHE_SIZE', 256))
+AV_INFO_CACHE_TTL = int(os.getenv('AV_INFO_CACHE_TTL', 900))
+
+av_info_results = TTLCache(AV_INFO_CACHE_SIZE, AV_INFO_CACHE_TTL)
+# running probes by url, callers of the same url wait for one ffprobe
+_av_info_probes = {}
+av_info_stats = {
+    'probes': 0,
+    'coalesced': 0
+}
+
+m3u8_probe_stats = {
+    'probes': 0,
+    'estimated': 0,
+    'exact_fallbacks': 0,
+    'segments_probed': 0,
+    'latency_last': 0.0,
+    'latency_total': 0.0
+}
 
 
 # convert each key-value to string like "key: value"
@@ -16,13 +48,40 @@ def dict_to_list(_dict):
     return ret
 
 async def av_info(url, http_headers=''):
+    info = av_info_results.get(url)
+    if info is not None:
+        return copy.deepcopy(info)
+    probe = _av_info_probes.get(url)
+    if probe is None:
+        # own task so cancelled caller doesn't break probe for others
+        probe = asyncio.get_event_loop().create_task(_probe_av_info(url, http_headers))
+        _av_info_probes[url] = probe
+        probe.add_done_callback(lambda _: _av_info_probes.pop(url, None))
+    else:
+        av_info_stats['coalesced'] += 1
+    return copy.deepcopy(await asyncio.shield(probe))
+
+
+async def _probe_av_info(url, http_headers=''):
+    av_info_stats['probes'] += 1
+    # container header is parsed in process if possible
+    info = await media_probe.probe(url, http_headers)
+    if info is not None:
+        av_info_results.set(url, info)
+        return info
     info = await _av_info(url, http_headers)
     if len(info.keys()) == 0:
         # some sites return error if headers was passed
         info = await _av_info(url)
+    if len(info.keys()) != 0:
+        av_info_results.set(url, info)
 
     return info
 
+
+def av_info_cache_stats():
+    return dict(av_info_results.stats(), **av_info_stats)
+
 async def _av_info(url, http_headers=''):
     # if use_m3u8:
     #     m3u8_obj = await asyncio.get_event_loop().run_in_executor(None, m3u8.load, url)
@@ -98,11 +157,7 @@ async def media_size(url, session=None, http_headers=None):
     return await _media_size(url, session)
 
 async def _media_size(url, session=None, http_headers=None):
-    _session = None
-    if session is None:
-        _session = await ClientSession(connector=TCPConnector(verify_ssl=False)).__aenter__()
-    else:
-        _session = session
+    _session = session if session is not None else http_pool.session()
     content_length = 0
     try:
         async with _session.head(url, headers=http_headers, allow_redirects=True) as resp:
@@ -114,16 +169,12 @@ async def _media_size(url, session=None, http_headers=None):
         print(e)
 
     # try GET request when HEAD failed
-    try:
-        if content_length < 100:
-            async with _session.get(url, headers=http_headers) as get_resp:
-                if get_resp.status != 200:
-                    raise Exception('Request failed: ' + str(get_resp.status) + " " + responses[get_resp.status])
-                else:
-                    content_length = int(get_resp.headers.get(hdrs.CONTENT_LENGTH, '0'))
-    finally:
-        if session is None:
-            await _session.__aexit__(exc_type=None, exc_val=None, exc_tb=None)
+    if content_length < 100:
+        async with _session.get(url, headers=http_headers) as get_resp:
+            if get_resp.status != 200:
+                raise Exception('Request failed: ' + str(get_resp.status) + " " + responses[get_resp.status])
+            else:
+                content_length = int(get_resp.headers.get(hdrs.CONTENT_LENGTH, '0'))
 
     return content_length
     # head_req = request.Request(url, method='HEAD', headers=http_headers)
@@ -135,18 +186,17 @@ async def _media_size(url, session=None, http_headers=None):
 
 
 async def media_mime(url, http_headers=None):
-    async with ClientSession(connector=TCPConnector(verify_ssl=False)) as session:
-        async with session.get(url, headers=http_headers) as get_resp:
-            if get_resp.content_disposition and get_resp.content_disposition.filename:
-                return None, get_resp.content_disposition.filename
-            _content_type = get_resp.headers.getall(hdrs.CONTENT_TYPE)
-            for ct in _content_type:
-                _media_type = ct.split('/')[0]
-                if _media_type == 'audio' or _media_type == 'video':
-                    return ct, None
-            else:
-                if len(_content_type) > 0:
-                    return _content_type[0], None
+    async with http_pool.session().get(url, headers=http_headers) as get_resp:
+        if get_resp.content_disposition and get_resp.content_disposition.filename:
+            return None, get_resp.content_disposition.filename
+        _content_type = get_resp.headers.getall(hdrs.CONTENT_TYPE)
+        for ct in _content_type:
+            _media_type = ct.split('/')[0]
+            if _media_type == 'audio' or _media_type == 'video':
+                return ct, None
+        else:
+            if len(_content_type) > 0:
+                return _content_type[0], None
 
 
 def m3u8_parse_url(url):
@@ -157,16 +207,73 @@ def m3u8_parse_url(url):
         return m3u8._parsed_url(url) + '/'
 
 
-async def m3u8_video_size(url, http_headers=None):
+async def m3u8_video_size(url, http_headers=None, tbr=None, exact_limit=None):
+    started = time.monotonic()
     m3u8_data = None
     m3u8_obj = None
-    async with ClientSession(connector=TCPConnector(verify_ssl=False)) as session:
-        async with session.get(url, headers=http_headers) as resp:
-            m3u8_data = await resp.read()
-            m3u8_obj = m3u8.loads(m3u8_data.decode())
-            m3u8_obj.base_uri = m3u8_parse_url(str(resp.url))
-        size = 0
-        for seg in m3u8_obj.segments:
-            size += await media_size(seg.absolute_uri, session=session, http_headers=http_headers)
+    session = http_pool.session()
+    async with session.get(url, headers=http_headers) as resp:
+        m3u8_data = await resp.read()
+        m3u8_obj = m3u8.loads(m3u8_data.decode())
+        m3u8_obj.base_uri = m3u8_parse_url(str(resp.url))
+    size, estimated = await _m3u8_segments_size(m3u8_obj.segments, session, http_headers, tbr)
+    if estimated:
+        m3u8_probe_stats['estimated'] += 1
+        low = size
+        size = int(size * (1 + M3U8_ESTIMATE_MARGIN / 100))
+        if exact_limit is not None and low <= exact_limit < size:
+            # only margin decides whether media fits the limit, so every segment is probed
+            m3u8_probe_stats['exact_fallbacks'] += 1
+            size, _ = await _m3u8_segments_size(m3u8_obj.segments, session, http_headers, exact=True)
 
+    latency = time.monotonic() - started
+    m3u8_probe_stats['probes'] += 1
+    m3u8_probe_stats['latency_last'] = latency
+    m3u8_probe_stats['latency_total'] += latency
     return size
+
+
+def _byterange_length(byterange):
+    return int(byterange.split('@')[0])
+
+
+async def _m3u8_segments_size(segments, session, http_headers=None, tbr=None, exact=False):
+    # returns size and whether it's estimated
+    if len(segments) == 0:
+        return 0, False
+    if all(s.byterange for s in segments):
+        return sum(_byterange_length(s.byterange) for s in segments), False
+
+    durations = [s.duration for s in segments if s.duration]
+    total_duration = sum(durations) if len(durations) == len(segments) else None
+    if tbr and total_duration and not exact:
+        # youtube_dl tbr is (average) bandwidth from master playlist in kbit/s
+        return int(tbr * 1000 / 8 * total_duration), True
+
+    sampled = segments
+    if len(segments) > M3U8_SAMPLE_SEGMENTS and not exact:
+        step = len(segments) / M3U8_SAMPLE_SEGMENTS
+        sampled = [segments[int(i * step)] for i in range(M3U8_SAMPLE_SEGMENTS)]
+
+    semaphore = asyncio.Semaphore(M3U8_PROBE_CONCURRENCY)
+
+    async def probe(seg):
+        async with semaphore:
+            return await media_size(seg.absolute_uri, session=session, http_headers=http_headers)
+
+    tasks = [asyncio.ensure_future(probe(s)) for s in sampled]
+    try:
+        sizes = await asyncio.gather(*tasks)
+    except:
+        for t in tasks:
+            t.cancel()
+        raise
+    m3u8_probe_stats['segments_probed'] += len(sampled)
+
+    if sampled is segments:
+        return sum(sizes), False
+    # extrapolate sampled segments size to whole playlist
+    sampled_duration = sum(s.duration for s in sampled) if total_duration else 0
+    if sampled_duration > 0:
+        return int(sum(sizes) / sampled_duration * total_duration), True
+    return int(sum(sizes) / len(sampled) * len(segments)), True
@@ -0,0 +1,34 @@
+class ChunkReader:
+    # assembles exact size chunks from stream which returns no more than requested
+    # (asyncio.StreamReader, aiohttp StreamReader), only missing part is requested
+    # so nothing is left over and every byte is copied at most once
+    def __init__(self, read_some):
+        self._read_some = read_some
+        self.copied = 0
+
+    async def readinto(self, buf):
+        view = memoryview(buf).cast('B')
+        filled = 0
+        while filled < len(view):
+            data = await self._read_some(len(view) - filled)
+            if not data:
+                break
+            view[filled:filled + len(data)] = data
+            filled += len(data)
+        self.copied += filled
+        return filled
+
+    async def read(self, n):
+        chunks = []
+        missing = n
+        while missing > 0:
+            data = await self._read_some(missing)
+            if not data:
+                break
+            chunks.append(data)
+            missing -= len(data)
+        if len(chunks) == 1:
+            return chunks[0]
+        chunk = b''.join(chunks)
+        self.copied += len(chunk)
+        return chunk
@@ -0,0 +1,203 @@
+import asyncio
+import json
+import os
+from aiohttp import BasicAuth, ClientTimeout
+import http_pool
+
+
+REQUEST_TIMEOUT = ClientTimeout(total=30)
+# rate limited requests are replayed like cloudant Replay429Adapter did
+COUCHDB_429_RETRIES = int(os.getenv('COUCHDB_429_RETRIES', 10))
+COUCHDB_429_BACKOFF = float(os.getenv('COUCHDB_429_BACKOFF', 0.25))
+
+
+class CouchDBError(Exception):
+    def __init__(self, status, reason):
+        super().__init__('couchdb error {}: {}'.format(status, reason))
+        self.status = status
+
+
+# minimal asyncio client of CouchDB/Cloudant database api on top of shared http pool
+class CouchDB:
+    def __init__(self, url, db_name, username=None, password=None):
+        self.url = url.rstrip('/') + '/' + db_name
+        self.auth = BasicAuth(username, password) if username is not None else None
+        self.requests = 0
+        self.throttled = 0
+
+    async def _request(self, method, path, ok=(200, 201, 202), **kwargs):
+        for attempt in range(COUCHDB_429_RETRIES + 1):
+            self.requests += 1
+            async with http_pool.session().request(method, self.url + path, auth=self.auth,
+                                                   timeout=REQUEST_TIMEOUT, **kwargs) as resp:
+                body = await resp.json(content_type=None)
+                if resp.status == 429 and attempt < COUCHDB_429_RETRIES:
+                    self.throttled += 1
+                    await asyncio.sleep(retry_delay(resp.headers.get('Retry-After'), attempt))
+                    continue
+                if resp.status not in ok:
+                    raise CouchDBError(resp.status, body.get('reason') if isinstance(body, dict) else body)
+                return resp.status, body
+
+    async def get(self, doc_id):
+        status, body = await self._request('GET', '/' + doc_id, ok=(200, 404))
+        return body if status == 200 else None
+
+    async def get_many(self, doc_ids):
+        # deleted and missing docs aren't returned
+        _, body = await self._request('POST', '/_all_docs', params={'include_docs': 'true'},
+                                      json={'keys': doc_ids})
+        return {row['id']: row['doc'] for row in body['rows'] if row.get('doc') is not None}
+
+    async def list_docs(self, limit=1000, start_key=None):
+        # page of docs ordered by id, next page starts after last returned id
+        params = {'include_docs': 'true', 'limit': str(limit)}
+        if start_key is not None:
+            params['startkey'] = json.dumps(start_key)
+            params['skip'] = '1'
+        _, body = await self._request('GET', '/_all_docs', params=params)
+        return [row['doc'] for row in body['rows']]
+
+    async def create(self, doc):
+        # returns existing doc if it was created by someone else
+        status, body = await self._request('PUT', '/' + doc['_id'], ok=(201, 202, 409), json=doc)
+        if status == 409:
+            return await self.get(doc['_id'])
+        doc['_rev'] = body['rev']
+        return doc
+
+    async def bulk_docs(self, docs):
+        _, body = await self._request('POST', '/_bulk_docs', json={'docs': docs})
+        return body
+
+    async def follow_changes(self, since='now', heartbeat=10):
+        # yields changes with docs and None on every heartbeat
+        params = {'feed': 'continuous', 'include_docs': 'true', 'since': since, 'heartbeat': str(heartbeat * 1000)}
+        timeout = ClientTimeout(total=None, sock_connect=30, sock_read=heartbeat * 3)
+        async with http_pool.session().get(self.url + '/_changes', params=params, auth=self.auth,
+                                           timeout=timeout) as resp:
+            if resp.status != 200:
+                raise CouchDBError(resp.status, await resp.text())
+            async for line in resp.content:
+                line = line.strip()
+                if not line:
+                    yield None
+                    continue
+                change = json.loads(line)
+                if 'last_seq' in change:
+                    return
+                yield change
+
+
+# merges field updates of the same docs made in short time into one _bulk_docs request,
+# conflicting docs get the same fields applied again onto their latest revision
+class DocWriter:
+    def __init__(self, db, lookup, delay, retries=5):
+        self.db = db
+        # returns locally known doc which is updated with written revision
+        self.lookup = lookup
+        self.delay = delay
+        self.retries = retries
+        self.updates = 0
+        self.writes = 0
+        self.docs_written = 0
+        self.conflicts = 0
+        self.failed = 0
+        self._pending = {}
+        self._flusher = None
+
+    def update(self, doc_id, fields):
+        self.updates += 1
+        if doc_id in self._pending:
+            delta, written = self._pending[doc_id]
+            delta.update(fields)
+        else:
+            written = asyncio.get_event_loop().create_future()
+            self._pending[doc_id] = (dict(fields), written)
+        if self._flusher is None:
+            self._flusher = asyncio.get_event_loop().create_task(self._flush())
+        return written
+
+    def pending(self, doc_id):
+        return self._pending[doc_id][0] if doc_id in self._pending else {}
+
+    async def _flush(self):
+        await asyncio.sleep(self.delay)
+        batch, self._pending = self._pending, {}
+        self._flusher = None
+        latest = {}
+        try:
+            for _ in range(self.retries):
+                docs = []
+                for doc_id, (delta, _) in batch.items():
+                    if doc_id in latest:
+                        base = latest[doc_id]
+                    else:
+                        base = self.lookup(doc_id) or {'_id': doc_id}
+                    doc = dict(base)
+                    doc.update(delta)
+                    docs.append(doc)
+                self.writes += 1
+                results = await self.db.bulk_docs(docs)
+                conflicted = {}
+                for doc, result in zip(docs, results):
+                    delta, written = batch[doc['_id']]
+                    if 'rev' in result:
+                        self._written(doc['_id'], result['rev'])
+                        self.docs_written += 1
+                        if not written.done():
+                            written.set_result(result['rev'])
+                    elif result.get('error') == 'conflict':
+                        conflicted[doc['_id']] = batch[doc['_id']]
+                    else:
+                        print('users write failed:', doc['_id'], result)
+                        self._fail(written, CouchDBError(result.get('error'), result.get('reason')))
+                if not conflicted:
+                    return
+                self.conflicts += len(conflicted)
+                batch = conflicted
+                latest = await self.db.get_many(list(batch))
+                for doc_id in batch:
+                    if doc_id not in latest:
+                        # deleted doc is created again from local copy
+                        base = dict(self.lookup(doc_id) or {'_id': doc_id})
+                        base.pop('_rev', None)
+                        latest[doc_id] = base
+            raise CouchDBError(409, 'conflict after {} retries'.format(self.retries))
+        except Exception as e:
+            print('users write failed:', e)
+            for _, written in batch.values():
+                self._fail(written, e)
+
+    def _fail(self, written, e):
+        if written.done():
+            return
+        self.failed += 1
+        written.set_exception(e)
+        # nobody may wait for it
+        written.exception()
+
+    def _written(self, doc_id, rev):
+        doc = self.lookup(doc_id)
+        if doc is not None and rev_num(rev) > rev_num(doc.get('_rev')):
+            doc['_rev'] = rev
+
+    def stats(self):
+        return {
+            'updates': self.updates,
+            'writes': self.writes,
+            'docs_written': self.docs_written,
+            'conflicts': self.conflicts,
+            'failed': self.failed,
+            'pending': len(self._pending)
+        }
+
+
+def retry_delay(retry_after, attempt):
+    if retry_after is not None and retry_after.isdigit():
+        return int(retry_after)
+    return COUCHDB_429_BACKOFF * 2 ** attempt
+
+
+def rev_num(rev):
+    return int(rev.split('-', 1)[0]) if rev else 0
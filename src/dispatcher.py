@@ -0,0 +1,173 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+import os
+import re
+from aiohttp import web, ClientError, ClientTimeout
+import http_pool
+from inflight import normalize_url
+
+
+# comma separated base urls of bot instances, like http://10.0.0.1:8080,http://10.0.0.2:8080
+DISPATCHER_INSTANCES = [i.strip().rstrip('/') for i in os.getenv('DISPATCHER_INSTANCES', '').split(',') if i.strip()]
+# 'chat' keeps chat on one instance, 'url' sends the same media to one instance
+DISPATCHER_KEY = os.getenv('DISPATCHER_KEY', 'chat')
+DISPATCHER_VNODES = int(os.getenv('DISPATCHER_VNODES', 100))
+DISPATCHER_HEALTH_INTERVAL = int(os.getenv('DISPATCHER_HEALTH_INTERVAL', 5))
+# failed health checks in row after which instance is taken out of ring
+DISPATCHER_HEALTH_FAILS = int(os.getenv('DISPATCHER_HEALTH_FAILS', 2))
+DISPATCHER_TIMEOUT = int(os.getenv('DISPATCHER_TIMEOUT', 10))
+
+url_re = re.compile(r'(?:https?://)?(?:[\w-]+\.)+[a-z]{2,}(?:/\S*)?', re.IGNORECASE)
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+# every instance owns many points on the ring, so when instance goes down
+# only its keys move and they are spread over the rest evenly
+class HashRing:
+    def __init__(self, nodes, vnodes=DISPATCHER_VNODES):
+        self.nodes = list(nodes)
+        self._points = sorted((_hash('{}#{}'.format(node, i)), node) for node in self.nodes for i in range(vnodes))
+        self._hashes = [p[0] for p in self._points]
+
+    def lookup(self, key, alive):
+        # nodes in preference order, first alive one owns the key
+        if not self._points:
+            return []
+        start = bisect.bisect(self._hashes, _hash(key))
+        found = []
+        for i in range(len(self._points)):
+            node = self._points[(start + i) % len(self._points)][1]
+            if node not in found and node in alive:
+                found.append(node)
+                if len(found) == len(alive):
+                    break
+        return found
+
+
+class Instance:
+    def __init__(self, url):
+        self.url = url
+        self.alive = True
+        self.fails = 0
+        self.forwarded = 0
+        self.errors = 0
+
+    def checked(self, ok):
+        if ok:
+            if not self.alive:
+                logging.warning('instance {} is back'.format(self.url))
+            self.fails = 0
+            self.alive = True
+            return
+        self.fails += 1
+        if self.alive and self.fails >= DISPATCHER_HEALTH_FAILS:
+            logging.warning('instance {} is down'.format(self.url))
+            self.alive = False
+
+
+def update_key(update):
+    if 'callback_query' in update:
+        callback = update['callback_query']
+        # settings buttons have no media url, callback goes where chat's messages without url go
+        message = callback.get('message') or {'chat': {'id': callback['from']['id']}}
+    else:
+        message = update.get('message') or update.get('edited_message') or {}
+        if DISPATCHER_KEY == 'url':
+            match = url_re.search(message.get('text', ''))
+            if match is not None:
+                return 'url:' + normalize_url(match.group(0))
+    return 'chat:{}'.format(message.get('chat', {}).get('id', update.get('update_id')))
+
+
+class Dispatcher:
+    def __init__(self, urls=DISPATCHER_INSTANCES):
+        self.instances = {url: Instance(url) for url in urls}
+        self.ring = HashRing(urls)
+        self.failovers = 0
+        self.rejected = 0
+        self._checker = None
+
+    def alive(self):
+        return set(url for url, i in self.instances.items() if i.alive)
+
+    async def _check(self, instance):
+        try:
+            async with http_pool.session().get(instance.url + '/health',
+                                               timeout=ClientTimeout(total=DISPATCHER_HEALTH_INTERVAL)) as resp:
+                instance.checked(resp.status == 200)
+        except (ClientError, asyncio.TimeoutError):
+            instance.checked(False)
+
+    async def _check_forever(self):
+        while True:
+            await asyncio.gather(*[self._check(i) for i in self.instances.values()])
+            await asyncio.sleep(DISPATCHER_HEALTH_INTERVAL)
+
+    async def start(self, _app=None):
+        self._checker = asyncio.get_event_loop().create_task(self._check_forever())
+
+    async def stop(self, _app=None):
+        if self._checker is not None:
+            self._checker.cancel()
+            self._checker = None
+
+    async def forward(self, body, key):
+        # next instances on ring take the key while owner doesn't respond
+        for url in self.ring.lookup(key, self.alive()):
+            instance = self.instances[url]
+            try:
+                async with http_pool.session().post(url + '/bot', data=body,
+                                                    headers={'Content-Type': 'application/json'},
+                                                    timeout=ClientTimeout(total=DISPATCHER_TIMEOUT)) as resp:
+                    if resp.status == 200:
+                        instance.forwarded += 1
+                        return True
+                    # instance is draining or broken
+                    instance.errors += 1
+            except (ClientError, asyncio.TimeoutError) as e:
+                logging.warning('forwarding to {} failed: {}'.format(url, e))
+                instance.errors += 1
+                instance.checked(False)
+            self.failovers += 1
+        self.rejected += 1
+        return False
+
+    async def on_update(self, request):
+        body = await request.read()
+        try:
+            key = update_key(await request.json())
+        except Exception as e:
+            print(e)
+            return web.Response(status=200)
+        # telegram redelivers update if no instance took it
+        return web.Response(status=200 if await self.forward(body, key) else 503)
+
+    async def on_stats(self, request):
+        return web.json_response({
+            'instances': {url: {
+                'alive': i.alive,
+                'forwarded': i.forwarded,
+                'errors': i.errors
+            } for url, i in self.instances.items()},
+            'failovers': self.failovers,
+            'rejected': self.rejected,
+            'http_pool': http_pool.stats()
+        })
+
+
+if __name__ == '__main__':
+    if not DISPATCHER_INSTANCES:
+        raise Exception('DISPATCHER_INSTANCES is not set')
+    dispatcher = Dispatcher()
+    app = web.Application()
+    app.add_routes([web.post('/bot', dispatcher.on_update),
+                    web.get('/stats', dispatcher.on_stats)])
+    app.on_startup.append(dispatcher.start)
+    app.on_cleanup.append(dispatcher.stop)
+    app.on_cleanup.append(http_pool.close)
+    web.run_app(app, port=int(os.getenv('PORT', 8080)))
@@ -0,0 +1,89 @@
+import copy
+import json
+import os
+import re
+import time
+import youtube_dl
+from urllib.error import HTTPError
+from youtube_dl.utils import ExtractorError
+from cache import TTLCache
+
+
+EXTRACT_CACHE_SIZE = int(os.getenv('EXTRACT_CACHE_SIZE', 1024))
+EXTRACT_CACHE_TTL = int(os.getenv('EXTRACT_CACHE_TTL', 1800))
+EXTRACT_NEGATIVE_TTL = int(os.getenv('EXTRACT_NEGATIVE_TTL', 300))
+# signed urls must stay valid long enough to download media
+EXPIRE_MARGIN = 15 * 60
+
+# params which affect extraction result
+_KEY_PARAMS = ['format', 'noplaylist', 'playlist_items', 'playliststart', 'playlistend',
+               'force_generic_extractor', 'username', 'youtube_include_dash_manifest']
+
+expire_re = re.compile(r'[?&/]expire[=/](\d{9,11})')
+
+results = TTLCache(EXTRACT_CACHE_SIZE, EXTRACT_CACHE_TTL)
+errors = TTLCache(EXTRACT_CACHE_SIZE, EXTRACT_NEGATIVE_TTL)
+
+
+def cache_key(url, params):
+    return url + '\n' + json.dumps({k: params.get(k) for k in _KEY_PARAMS}, sort_keys=True)
+
+
+def _urls(info):
+    if not isinstance(info, dict):
+        return
+    if isinstance(info.get('url'), str):
+        yield info['url']
+    for k in ['formats', 'requested_formats', 'entries']:
+        for i in info.get(k) or []:
+            yield from _urls(i)
+
+
+def info_ttl(info):
+    ttl = EXTRACT_CACHE_TTL
+    now = time.time()
+    for u in _urls(info):
+        match = expire_re.search(u)
+        if match:
+            ttl = min(ttl, int(match.group(1)) - now - EXPIRE_MARGIN)
+    return ttl
+
+
+def is_permanent_error(e):
+    if e.exc_info is None or e.exc_info[1] is None:
+        return 'Unsupported URL' in str(e)
+    err = e.exc_info[1]
+    if isinstance(err, HTTPError):
+        return err.code in [404, 410]
+    if isinstance(err, ExtractorError):
+        # errors caused by network failures are worth retrying
+        return err.cause is None and (err.exc_info is None or err.exc_info[0] is None)
+    return False
+
+
+def get(url, params):
+    key = cache_key(url, params)
+    error = errors.get(key)
+    if error is not None:
+        raise youtube_dl.DownloadError(*error)
+    info = results.get(key)
+    if info is not None:
+        return copy.deepcopy(info)
+    return None
+
+
+def put(url, params, info):
+    results.set(cache_key(url, params), copy.deepcopy(info), ttl=info_ttl(info))
+
+
+def put_error(url, params, e):
+    if is_permanent_error(e):
+        exc_info = (e.exc_info[0], e.exc_info[1], None) if e.exc_info is not None else None
+        errors.set(cache_key(url, params), (str(e), exc_info))
+
+
+def stats():
+    return {
+        'results': results.stats(),
+        'errors': errors.stats()
+    }
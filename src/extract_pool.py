@@ -0,0 +1,244 @@
+import asyncio
+import io
+import os
+import pickle
+import signal
+import struct
+import sys
+import time
+from collections import deque
+from urllib.error import HTTPError
+
+
+EXTRACT_WORKERS = int(os.getenv('EXTRACT_WORKERS', 2))
+EXTRACT_TIMEOUT = int(os.getenv('EXTRACT_TIMEOUT', 300))
+
+_header = struct.Struct('<I')
+
+
+class ExtractTimeoutError(Exception):
+    pass
+
+
+class _Response(io.BytesIO):
+    def __init__(self, code):
+        super().__init__()
+        self.code = code
+
+
+# urllib HTTPError keeps an opened response so it can't be pickled
+class RemoteHTTPError(HTTPError):
+    def __init__(self, url, code, msg):
+        super().__init__(url, code, msg, None, _Response(code))
+
+    def __reduce__(self):
+        return RemoteHTTPError, (self.url, self.code, self.msg)
+
+
+def _portable_value(value):
+    if isinstance(value, HTTPError):
+        return RemoteHTTPError(value.url, value.code, value.msg)
+    # tracebacks can't be pickled
+    if getattr(value, 'exc_info', None) is not None:
+        value.exc_info = (value.exc_info[0], _portable_value(value.exc_info[1]), None)
+    if hasattr(value, 'traceback'):
+        value.traceback = None
+    try:
+        pickle.dumps(value)
+    except Exception:
+        return Exception(str(value))
+    return value
+
+
+def _portable_error(e):
+    import youtube_dl
+    if isinstance(e, youtube_dl.DownloadError):
+        exc_info = None
+        if e.exc_info is not None:
+            exc_info = (e.exc_info[0], _portable_value(e.exc_info[1]), None)
+        return youtube_dl.DownloadError(str(e), exc_info)
+    return _portable_value(e)
+
+
+def _write(out, data):
+    out.write(_header.pack(len(data)) + data)
+    out.flush()
+
+
+def _read(inp):
+    header = inp.read(_header.size)
+    if len(header) < _header.size:
+        return None
+    return inp.read(_header.unpack(header)[0])
+
+
+def _worker_main():
+    import youtube_dl
+    # youtube-dl autoupdate sends SIGHUP to every python process, pool recycles workers itself
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    # protocol uses original stdout, everything printed by youtube_dl goes to stderr
+    out = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    inp = sys.stdin.buffer
+
+    # extractors keep their caches (like deciphered youtube signatures)
+    # between jobs so instances are reused while worker alive
+    ydls = {}
+    while True:
+        job = _read(inp)
+        if job is None:
+            return
+        url, params = pickle.loads(job)
+        opener_key = (params.get('nocheckcertificate'), params.get('proxy'), params.get('cookiefile'))
+        ydl = ydls.get(opener_key)
+        if ydl is None:
+            ydl = ydls[opener_key] = youtube_dl.YoutubeDL(params=params)
+        ydl.params = params
+        try:
+            info = ydl.extract_info(url,
+                                    download=False,
+                                    force_generic_extractor=params.get('force_generic_extractor', False))
+            result = pickle.dumps((True, info))
+        except BaseException as e:
+            result = pickle.dumps((False, _portable_error(e)))
+        _write(out, result)
+
+
+class _Worker:
+    def __init__(self, proc, generation):
+        self.proc = proc
+        self.generation = generation
+        self.jobs = 0
+
+    @staticmethod
+    async def spawn(generation):
+        proc = await asyncio.create_subprocess_exec(sys.executable,
+                                                    os.path.abspath(__file__),
+                                                    stdin=asyncio.subprocess.PIPE,
+                                                    stdout=asyncio.subprocess.PIPE)
+        return _Worker(proc, generation)
+
+    @property
+    def alive(self):
+        return self.proc.returncode is None
+
+    async def call(self, url, params):
+        data = pickle.dumps((url, params))
+        self.proc.stdin.write(_header.pack(len(data)) + data)
+        await self.proc.stdin.drain()
+        header = await self.proc.stdout.readexactly(_header.size)
+        ok, result = pickle.loads(await self.proc.stdout.readexactly(_header.unpack(header)[0]))
+        self.jobs += 1
+        return ok, result
+
+    async def kill(self):
+        try:
+            self.proc.kill()
+        except ProcessLookupError:
+            pass
+        await self.proc.wait()
+
+    async def stop(self):
+        self.proc.stdin.close()
+        try:
+            await asyncio.wait_for(self.proc.wait(), timeout=10)
+        except asyncio.TimeoutError:
+            await self.kill()
+
+
+# pool of youtube_dl worker processes, extraction doesn't hold GIL of
+# event loop process and stuck extraction can be killed by deadline
+class ExtractPool:
+    def __init__(self, size=EXTRACT_WORKERS, timeout=EXTRACT_TIMEOUT):
+        self.size = size
+        self.timeout = timeout
+        self.generation = 0
+        self.completed = 0
+        self.failed = 0
+        self.killed = 0
+        self.busy = 0
+        self._latency = deque(maxlen=200)
+        self._wait_time = deque(maxlen=200)
+        self._queue = None
+        self._slots = []
+
+    @property
+    def enabled(self):
+        return self.size > 0
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        for _ in range(self.size):
+            worker = await _Worker.spawn(self.generation)
+            self._slots.append(asyncio.get_event_loop().create_task(self._run_slot(worker)))
+
+    async def stop(self):
+        for s in self._slots:
+            s.cancel()
+        self._slots = []
+
+    def recycle(self):
+        # workers are replaced after finishing current job
+        self.generation += 1
+
+    async def extract(self, url, params, timeout=None):
+        future = asyncio.get_event_loop().create_future()
+        await self._queue.put((url, params, timeout or self.timeout, future, time.monotonic()))
+        return await future
+
+    async def _run_slot(self, worker):
+        try:
+            while True:
+                url, params, timeout, future, enqueued = await self._queue.get()
+                if future.done():
+                    continue
+                if not worker.alive or worker.generation != self.generation:
+                    if worker.alive:
+                        await worker.stop()
+                    worker = await _Worker.spawn(self.generation)
+                self._wait_time.append(time.monotonic() - enqueued)
+                started = time.monotonic()
+                self.busy += 1
+                try:
+                    ok, result = await asyncio.wait_for(worker.call(url, params), timeout=timeout)
+                    self.completed += 1
+                    if not future.done():
+                        if ok:
+                            future.set_result(result)
+                        else:
+                            future.set_exception(result)
+                except asyncio.TimeoutError:
+                    self.killed += 1
+                    await worker.kill()
+                    if not future.done():
+                        future.set_exception(ExtractTimeoutError('Extraction took more than {} seconds'.format(timeout)))
+                except Exception as e:
+                    # worker is in unknown state after protocol failure
+                    self.failed += 1
+                    await worker.kill()
+                    if not future.done():
+                        future.set_exception(Exception('Extraction worker failed: ' + str(e)))
+                finally:
+                    self.busy -= 1
+                    self._latency.append(time.monotonic() - started)
+        finally:
+            if worker.alive:
+                await worker.kill()
+
+    def stats(self):
+        latency = sorted(self._latency)
+        return {
+            'workers': self.size,
+            'busy': self.busy,
+            'queue_depth': self._queue.qsize() if self._queue is not None else 0,
+            'completed': self.completed,
+            'failed': self.failed,
+            'killed': self.killed,
+            'latency_avg': sum(latency) / len(latency) if latency else 0,
+            'latency_p95': latency[int(len(latency) * 0.95)] if latency else 0,
+            'wait_avg': sum(self._wait_time) / len(self._wait_time) if self._wait_time else 0
+        }
+
+
+if __name__ == '__main__':
+    _worker_main()
@@ -7,13 +7,17 @@ import hashlib
 import inspect
 import logging
 import os
-from collections import defaultdict
-from typing import Optional, List, AsyncGenerator, Union, Awaitable, DefaultDict, Tuple, BinaryIO
+import struct
+import time
+import weakref
+from collections import defaultdict, deque
+from typing import Optional, List, AsyncGenerator, Union, Awaitable, DefaultDict, Dict, Tuple, BinaryIO
 
 import math
 from telethon import utils, helpers, TelegramClient
 from telethon.crypto import AuthKey
 from telethon.network import MTProtoSender
+from telethon.tl.functions import PingRequest
 from telethon.tl.functions.auth import ExportAuthorizationRequest, ImportAuthorizationRequest
 from telethon.tl.functions.upload import (GetFileRequest, SaveFilePartRequest,
                                           SaveBigFilePartRequest)
@@ -26,6 +30,18 @@ logging.basicConfig(level=logging.WARNING)
 TypeLocation = Union[Document, InputDocumentFileLocation, InputPeerPhotoFileLocation,
                      InputFileLocation, InputPhotoFileLocation]
 
+# telegram drops connections above per account limit, keep it in line with TG_MAX_PARALLEL_CONNECTIONS
+TG_SENDER_POOL_SIZE = int(os.getenv('TG_SENDER_POOL_SIZE', 30))
+TG_SENDER_IDLE_TIMEOUT = int(os.getenv('TG_SENDER_IDLE_TIMEOUT', 300))
+# how long transfer waits for a sender when all pooled senders are in use
+TG_SENDER_POOL_WAIT = int(os.getenv('TG_SENDER_POOL_WAIT', 60))
+# idle senders are pinged before reuse
+TG_SENDER_PING_AFTER = int(os.getenv('TG_SENDER_PING_AFTER', 60))
+# file parts in flight per upload connection
+TG_UPLOAD_WINDOW = int(os.getenv('TG_UPLOAD_WINDOW', 4))
+# how often running upload with connections grant adds free connections or gives them back
+TG_UPLOAD_REBALANCE_INTERVAL = int(os.getenv('TG_UPLOAD_REBALANCE_INTERVAL', 5))
+
 
 async def stream_file(file_to_stream: BinaryIO, chunk_size=1024):
     while True:
@@ -40,6 +56,7 @@ class DownloadSender:
     request: GetFileRequest
     remaining: int
     stride: int
+    error: Optional[BaseException]
 
     def __init__(self, sender: MTProtoSender, file: TypeLocation, offset: int, limit: int,
                  stride: int, count: int) -> None:
@@ -47,6 +64,7 @@ class DownloadSender:
         self.request = GetFileRequest(file, offset=offset, limit=limit)
         self.stride = stride
         self.remaining = count
+        self.error = None
 
     async def next(self) -> Optional[bytes]:
         if not self.remaining:
@@ -56,46 +74,351 @@ class DownloadSender:
         self.request.offset += self.stride
         return result.bytes
 
-    def disconnect(self) -> Awaitable[None]:
-        return self.sender.disconnect()
+    async def finish(self) -> None:
+        pass
+
+    async def abort(self) -> None:
+        pass
 
 
 class UploadSender:
     sender: MTProtoSender
-    request: Union[SaveFilePartRequest, SaveBigFilePartRequest]
-    part_count: int
-    stride: int
-    previous: Optional[asyncio.Task]
-    loop: asyncio.AbstractEventLoop
+    transferrer: 'ParallelTransferrer'
+    workers: List[asyncio.Task]
+    error: Optional[BaseException]
 
-    def __init__(self, sender: MTProtoSender, file_id: int, part_count: int, big: bool, index: int,
-                 stride: int, loop: asyncio.AbstractEventLoop) -> None:
+    def __init__(self, sender: MTProtoSender, transferrer: 'ParallelTransferrer', window: int,
+                 loop: asyncio.AbstractEventLoop) -> None:
         self.sender = sender
-        self.part_count = part_count
-        if big:
-            self.request = SaveBigFilePartRequest(file_id, index, part_count, b"")
-        else:
-            self.request = SaveFilePartRequest(file_id, index, b"")
-        self.stride = stride
-        self.previous = None
-        self.loop = loop
+        self.transferrer = transferrer
+        self.error = None
+        self.retired = False
+        self._waiting = set()
+        self.parts = 0
+        self.bytes = 0
+        self.send_time = 0.0
+        self.started = time.monotonic()
+        # each worker keeps one part in flight, parts are taken from queue shared with other senders
+        # so slow connection just sends less parts
+        self.workers = [loop.create_task(self._work()) for _ in range(window)]
+
+    async def _work(self) -> None:
+        queue = self.transferrer.parts
+        worker = asyncio.current_task()
+        while self.error is None and not self.retired:
+            self._waiting.add(worker)
+            try:
+                part, data, buf = await queue.get()
+            finally:
+                self._waiting.discard(worker)
+            try:
+                log.debug(f"Sending file part {part}/{self.transferrer.part_count}"
+                          f" with {len(data)} bytes")
+                started = time.monotonic()
+                await self.sender.send(self.transferrer.part_request(part, data))
+                self.send_time += time.monotonic() - started
+                self.parts += 1
+                self.bytes += len(data)
+                if buf is not None:
+                    self.transferrer.buffers.release(buf)
+                self.transferrer.part_sent(part)
+                self.transferrer.release_window()
+            except Exception as e:
+                # part goes back to other senders
+                self.error = e
+                queue.put_nowait((part, data, buf))
+                self.transferrer.sender_failed(e)
+            finally:
+                queue.task_done()
+
+    async def finish(self) -> None:
+        for w in self.workers:
+            w.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+
+    async def abort(self) -> None:
+        await self.finish()
+
+    async def retire(self) -> None:
+        # parts in flight are sent, then workers stop
+        self.retired = True
+        for w in self._waiting:
+            w.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+
+    def stats(self) -> dict:
+        elapsed = time.monotonic() - self.started
+        return {
+            'parts': self.parts,
+            'bytes': self.bytes,
+            'throughput': self.bytes / elapsed if elapsed > 0 else 0,
+            'latency_avg': self.send_time / self.parts if self.parts else 0,
+            'failed': self.error is not None
+        }
+
+
+def _tl_bytes(data: Union[bytes, memoryview]) -> Tuple[bytes, Union[bytes, memoryview], bytes]:
+    # length prefix and padding of TL bytes, data itself isn't copied
+    n = len(data)
+    if n < 254:
+        return bytes([n]), data, bytes(-(n + 1) % 4)
+    return bytes([254, n & 0xff, (n >> 8) & 0xff, (n >> 16) & 0xff]), data, bytes(-n % 4)
+
+
+# parts are memoryviews of reused buffers, serialized with single copy
+class _SaveBigFilePartRequest(SaveBigFilePartRequest):
+    def _bytes(self) -> bytes:
+        return b''.join((struct.pack('<Iqii', self.CONSTRUCTOR_ID, self.file_id, self.file_part,
+                                     self.file_total_parts),
+                         *_tl_bytes(self.bytes)))
+
+
+class _SaveFilePartRequest(SaveFilePartRequest):
+    def _bytes(self) -> bytes:
+        return b''.join((struct.pack('<Iqi', self.CONSTRUCTOR_ID, self.file_id, self.file_part),
+                         *_tl_bytes(self.bytes)))
+
+
+active_part_buffers = weakref.WeakSet()
+
+
+class PartBuffers:
+    part_size: int
+    free: List[bytearray]
+
+    # part sized buffers reused during upload, their count is bounded by upload window
+    def __init__(self, part_size: int) -> None:
+        self.part_size = part_size
+        self.free = []
+        self.allocated = 0
+        active_part_buffers.add(self)
+
+    @property
+    def allocated_bytes(self) -> int:
+        return self.allocated * self.part_size
+
+    def acquire(self) -> bytearray:
+        if self.free:
+            return self.free.pop()
+        self.allocated += 1
+        return bytearray(self.part_size)
+
+    def release(self, buf: bytearray) -> None:
+        self.free.append(buf)
+
+    async def read_part(self, source: BinaryIO) -> Tuple[Optional[memoryview], Optional[bytearray]]:
+        # fills buffer straight from source if it supports readinto
+        readinto = getattr(source, 'readinto', None)
+        if readinto is None:
+            data = await source.read(self.part_size)
+            if len(data) == self.part_size or not data:
+                return (memoryview(data) if data else None), None
+        buf = self.acquire()
+        view = memoryview(buf)
+        filled = 0
+        if readinto is None:
+            view[:len(data)] = data
+            filled = len(data)
+        while filled < self.part_size:
+            if readinto is not None:
+                n = await readinto(view[filled:])
+            else:
+                data = await source.read(self.part_size - filled)
+                n = len(data)
+                view[filled:filled + n] = data
+            if not n:
+                break
+            filled += n
+        if filled == 0:
+            self.release(buf)
+            return None, None
+        return view[:filled], buf
 
-    async def next(self, data: bytes) -> None:
-        if self.previous:
-            await self.previous
-        self.previous = self.loop.create_task(self._next(data))
 
-    async def _next(self, data: bytes) -> None:
-        self.request.bytes = data
-        log.debug(f"Sending file part {self.request.file_part}/{self.part_count}"
-                  f" with {len(data)} bytes")
-        await self.sender.send(self.request)
-        self.request.file_part += self.stride
+class SenderPoolTimeoutError(Exception):
+    pass
 
-    async def disconnect(self) -> None:
-        if self.previous:
-            await self.previous
-        return await self.sender.disconnect()
+
+class SenderPool:
+    client: TelegramClient
+    max_size: int
+    idle_timeout: int
+
+    def __init__(self, client: TelegramClient, max_size: int = TG_SENDER_POOL_SIZE,
+                 idle_timeout: int = TG_SENDER_IDLE_TIMEOUT) -> None:
+        self.client = client
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.created = 0
+        self.reused = 0
+        self.evicted = 0
+        self.unhealthy = 0
+        self.timed_out = 0
+        self._idle: DefaultDict[int, List[Tuple[MTProtoSender, float]]] = defaultdict(list)
+        self._open: DefaultDict[int, int] = defaultdict(int)
+        self._auth_keys: Dict[int, AuthKey] = {}
+        self._auth_locks: DefaultDict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self._released: Optional[asyncio.Event] = None
+        self._evictor: Optional[asyncio.Task] = None
+        self._closed = False
+
+    @property
+    def size(self) -> int:
+        return sum(self._open.values())
+
+    async def _connect(self, dc_id: int, auth_key: Optional[AuthKey]) -> MTProtoSender:
+        dc = await self.client._get_dc(dc_id)
+        sender = MTProtoSender(auth_key, self.client.loop, loggers=self.client._log)
+        await sender.connect(self.client._connection(dc.ip_address, dc.port, dc.id,
+                                                     loop=self.client.loop, loggers=self.client._log,
+                                                     proxy=self.client._proxy))
+        if not auth_key:
+            log.debug(f"Exporting auth to DC {dc_id}")
+            auth = await self.client(ExportAuthorizationRequest(dc_id))
+            req = self.client._init_with(ImportAuthorizationRequest(
+                id=auth.id, bytes=auth.bytes
+            ))
+            await sender.send(req)
+            self._auth_keys[dc_id] = sender.auth_key
+        return sender
+
+    async def _create(self, dc_id: int) -> MTProtoSender:
+        if dc_id == self.client.session.dc_id:
+            return await self._connect(dc_id, self.client.session.auth_key)
+        if dc_id not in self._auth_keys:
+            # only the first cross-DC sender exports the authorization
+            async with self._auth_locks[dc_id]:
+                if dc_id not in self._auth_keys:
+                    return await self._connect(dc_id, None)
+        return await self._connect(dc_id, self._auth_keys[dc_id])
+
+    async def _healthy(self, sender: MTProtoSender, since: float) -> bool:
+        if not sender.is_connected():
+            return False
+        if time.monotonic() - since < TG_SENDER_PING_AFTER:
+            return True
+        try:
+            await asyncio.wait_for(sender.send(PingRequest(helpers.generate_random_long())), timeout=10)
+            return True
+        except Exception as e:
+            log.debug(f"Pooled sender failed health check: {e}")
+            return False
+
+    def _discard(self, dc_id: int, sender: MTProtoSender) -> None:
+        self._open[dc_id] -= 1
+        if self._open[dc_id] <= 0:
+            del self._open[dc_id]
+        self.client.loop.create_task(sender.disconnect())
+        if self._released is not None:
+            self._released.set()
+
+    def _evict_idle(self, exclude_dc: Optional[int] = None) -> bool:
+        # frees place for sender to another DC
+        for dc_id, idle in self._idle.items():
+            if dc_id != exclude_dc and idle:
+                sender, _ = idle.pop(0)
+                self._discard(dc_id, sender)
+                self.evicted += 1
+                return True
+        return False
+
+    async def _evict_expired(self) -> None:
+        while True:
+            await asyncio.sleep(min(self.idle_timeout, 30))
+            deadline = time.monotonic() - self.idle_timeout
+            for dc_id, idle in self._idle.items():
+                expired = [(s, t) for s, t in idle if t < deadline]
+                idle[:] = [(s, t) for s, t in idle if t >= deadline]
+                for sender, _ in expired:
+                    self._discard(dc_id, sender)
+                    self.evicted += 1
+
+    async def acquire(self, dc_id: int, timeout: float = TG_SENDER_POOL_WAIT) -> MTProtoSender:
+        deadline = time.monotonic() + timeout
+        if self._released is None:
+            self._released = asyncio.Event()
+        if self._evictor is None:
+            self._evictor = self.client.loop.create_task(self._evict_expired())
+        while True:
+            self._released.clear()
+            idle = self._idle[dc_id]
+            while idle:
+                # the most recently used sender is the least likely to be dropped by server
+                sender, since = idle.pop()
+                if await self._healthy(sender, since):
+                    self.reused += 1
+                    return sender
+                self.unhealthy += 1
+                self._discard(dc_id, sender)
+            if self.size >= self.max_size:
+                self._evict_idle(exclude_dc=dc_id)
+            if self.size < self.max_size:
+                self._open[dc_id] += 1
+                try:
+                    sender = await self._create(dc_id)
+                except BaseException:
+                    self._open[dc_id] -= 1
+                    self._released.set()
+                    raise
+                self.created += 1
+                return sender
+            # leaked or stuck holders must not hang every later transfer
+            try:
+                await asyncio.wait_for(self._released.wait(), timeout=max(deadline - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                self.timed_out += 1
+                raise SenderPoolTimeoutError(f"No telegram sender to DC {dc_id} was freed in {timeout}s, "
+                                             f"all {self.max_size} pooled senders are in use")
+
+    def release(self, dc_id: int, sender: MTProtoSender, healthy: bool = True) -> None:
+        if self._closed or not healthy or not sender.is_connected():
+            if not healthy:
+                self.unhealthy += 1
+            self._discard(dc_id, sender)
+            return
+        self._idle[dc_id].append((sender, time.monotonic()))
+        self._released.set()
+
+    async def close(self) -> None:
+        self._closed = True
+        if self._evictor is not None:
+            self._evictor.cancel()
+            self._evictor = None
+        senders = []
+        for dc_id, idle in self._idle.items():
+            for sender, _ in idle:
+                self._open[dc_id] -= 1
+                senders.append(sender.disconnect())
+            if self._open[dc_id] <= 0:
+                del self._open[dc_id]
+        self._idle.clear()
+        await asyncio.gather(*senders, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            'max_size': self.max_size,
+            'open': dict(self._open),
+            'idle': {dc_id: len(idle) for dc_id, idle in self._idle.items() if idle},
+            'created': self.created,
+            'reused': self.reused,
+            'evicted': self.evicted,
+            'unhealthy': self.unhealthy,
+            'timed_out': self.timed_out
+        }
+
+
+sender_pools: Dict[TelegramClient, SenderPool] = {}
+
+
+def sender_pool(client: TelegramClient) -> SenderPool:
+    pool = sender_pools.get(client)
+    if pool is None:
+        pool = sender_pools[client] = SenderPool(client)
+    return pool
+
+
+def upload_part_size(file_size: int) -> int:
+    return utils.get_appropriated_part_size(file_size) * 1024
 
 
 class ParallelTransferrer:
@@ -103,20 +426,58 @@ class ParallelTransferrer:
     loop: asyncio.AbstractEventLoop
     dc_id: int
     senders: Optional[List[Union[DownloadSender, UploadSender]]]
-    auth_key: AuthKey
-    upload_ticker: int
+    pool: SenderPool
+    parts: Optional[asyncio.Queue]
+    window: Optional[asyncio.Semaphore]
+    error: Optional[BaseException]
 
-    def __init__(self, client: TelegramClient, dc_id: Optional[int] = None) -> None:
+    def __init__(self, client: TelegramClient, dc_id: Optional[int] = None, grant=None) -> None:
         self.client = client
         self.loop = self.client.loop
         self.dc_id = dc_id or self.client.session.dc_id
-        self.auth_key = (None if dc_id and self.client.session.dc_id != dc_id
-                         else self.client.session.auth_key)
+        self.pool = sender_pool(client)
         self.senders = None
-        self.upload_ticker = 0
+        self.parts = None
+        self.window = None
+        self.error = None
+        self.failed = asyncio.Event()
+        self.file_id = 0
+        self.part_count = 0
+        self.big = False
+        self.buffers = None
+        self.next_part = 0
+        self.checkpoint = None
+        self._sent_parts = set()
+        # connections grant of upload, senders are added and retired along with it
+        self.grant = grant
+        self.sender_window = 1
+        self._window_debt = 0
+        self._rebalanced = time.monotonic()
+        self._rebalancing = None
 
     async def _cleanup(self) -> None:
-        await asyncio.gather(*[sender.disconnect() for sender in self.senders])
+        # senders go back to pool, failed ones are dropped
+        if self._rebalancing is not None:
+            await asyncio.gather(self._rebalancing, return_exceptions=True)
+        await asyncio.gather(*[sender.finish() for sender in self.senders])
+        for sender in self.senders:
+            self.pool.release(self.dc_id, sender.sender, healthy=sender.error is None)
+            if isinstance(sender, UploadSender):
+                _record_upload_sender(sender.stats())
+        if self.buffers is not None:
+            upload_buffer_peaks.append(self.buffers.allocated_bytes)
+        self.senders = None
+
+    async def abort(self) -> None:
+        # requests may be still in flight, so senders aren't reused
+        if self._rebalancing is not None:
+            self._rebalancing.cancel()
+            await asyncio.gather(self._rebalancing, return_exceptions=True)
+        if not self.senders:
+            return
+        for sender in self.senders:
+            await sender.abort()
+            self.pool.release(self.dc_id, sender.sender, healthy=False)
         self.senders = None
 
     @staticmethod
@@ -128,6 +489,14 @@ class ParallelTransferrer:
             return max_count
         return math.ceil((file_size / full_size) * max_count)
 
+    async def _init_senders(self, creating: List[Awaitable[Union[DownloadSender, UploadSender]]]) -> None:
+        senders = await asyncio.gather(*creating, return_exceptions=True)
+        self.senders = [s for s in senders if not isinstance(s, BaseException)]
+        for s in senders:
+            if isinstance(s, BaseException):
+                await self._cleanup()
+                raise s
+
     async def _init_download(self, connections: int, file: TypeLocation, part_count: int,
                              part_size: int) -> None:
         minimum, remainder = divmod(part_count, connections)
@@ -139,16 +508,9 @@ class ParallelTransferrer:
                 return minimum + 1
             return minimum
 
-        # The first cross-DC sender will export+import the authorization, so we always create it
-        # before creating any other senders.
-        self.senders = [
-            await self._create_download_sender(file, 0, part_size, connections * part_size,
-                                               get_part_count()),
-            *await asyncio.gather(
-                *[self._create_download_sender(file, i, part_size, connections * part_size,
-                                               get_part_count())
-                  for i in range(1, connections)])
-        ]
+        await self._init_senders([self._create_download_sender(file, i, part_size, connections * part_size,
+                                                               get_part_count())
+                                  for i in range(connections)])
 
     async def _create_download_sender(self, file: TypeLocation, index: int, part_size: int,
                                       stride: int,
@@ -156,51 +518,136 @@ class ParallelTransferrer:
         return DownloadSender(await self._create_sender(), file, index * part_size, part_size,
                               stride, part_count)
 
-    async def _init_upload(self, connections: int, file_id: int, part_count: int, big: bool
-                           ) -> None:
-        self.senders = [
-            await self._create_upload_sender(file_id, part_count, big, 0, connections),
-            *await asyncio.gather(
-                *[self._create_upload_sender(file_id, part_count, big, i, connections)
-                  for i in range(1, connections)])
-        ]
-
-    async def _create_upload_sender(self, file_id: int, part_count: int, big: bool, index: int,
-                                    stride: int) -> UploadSender:
-        return UploadSender(await self._create_sender(), file_id, part_count, big, index, stride,
-                            loop=self.loop)
-
-    async def _create_sender(self) -> MTProtoSender:
-        dc = await self.client._get_dc(self.dc_id)
-        sender = MTProtoSender(self.auth_key, self.loop, loggers=self.client._log)
-        await sender.connect(self.client._connection(dc.ip_address, dc.port, dc.id,
-                                                     loop=self.loop, loggers=self.client._log,
-                                                     proxy=self.client._proxy))
-        if not self.auth_key:
-            log.debug(f"Exporting auth to DC {self.dc_id}")
-            auth = await self.client(ExportAuthorizationRequest(self.dc_id))
-            req = self.client._init_with(ImportAuthorizationRequest(
-                id=auth.id, bytes=auth.bytes
-            ))
-            await sender.send(req)
-            self.auth_key = sender.auth_key
-        return sender
+    async def _init_upload(self, connections: int, file_id: int, part_count: int, part_size: int,
+                           big: bool, window: int) -> None:
+        self.file_id = file_id
+        self.part_count = part_count
+        self.big = big
+        self.parts = asyncio.Queue()
+        self.buffers = PartBuffers(part_size)
+        self.sender_window = window
+        # bounds memory held by parts waiting for upload
+        self.window = asyncio.Semaphore(connections * window)
+        await self._init_senders([self._create_upload_sender(window) for _ in range(connections)])
+
+    async def _create_upload_sender(self, window: int) -> UploadSender:
+        return UploadSender(await self._create_sender(), self, window, loop=self.loop)
+
+    def part_request(self, part: int, data: memoryview) -> Union[SaveFilePartRequest, SaveBigFilePartRequest]:
+        # total parts may be corrected when source ends before expected size
+        if self.big:
+            return _SaveBigFilePartRequest(self.file_id, part, self.part_count, data)
+        return _SaveFilePartRequest(self.file_id, part, data)
+
+    def resume(self, checkpoint) -> None:
+        # parts before checkpoint were acknowledged by previous upload of the same file_id
+        self.checkpoint = checkpoint
+        self.next_part = checkpoint.parts
+
+    def part_sent(self, part: int) -> None:
+        if self.checkpoint is None:
+            return
+        self._sent_parts.add(part)
+        contiguous = self.checkpoint.parts
+        while contiguous in self._sent_parts:
+            self._sent_parts.remove(contiguous)
+            contiguous += 1
+        self.checkpoint.acked(contiguous)
+
+    def release_window(self) -> None:
+        # retired senders' share of window isn't given back
+        if self._window_debt > 0:
+            self._window_debt -= 1
+        else:
+            self.window.release()
+
+    def _rebalance(self) -> None:
+        if self.grant is None or self._rebalancing is not None or not TG_UPLOAD_REBALANCE_INTERVAL or \
+                time.monotonic() - self._rebalanced < TG_UPLOAD_REBALANCE_INTERVAL:
+            return
+        self._rebalanced = time.monotonic()
+        wanted = self.grant.wanted()
+        if wanted < 0:
+            healthy = [s for s in self.senders if s.error is None]
+            if len(healthy) < 2:
+                return
+            sender = healthy[-1]
+            self.senders.remove(sender)
+            self._window_debt += self.sender_window
+            self._rebalancing = self.loop.create_task(self._retire_sender(sender))
+        elif wanted > 0 and self.part_count - self.next_part > 4 * len(self.senders) * self.sender_window:
+            # only while there are enough parts left for more senders
+            n = self.grant.grow(wanted)
+            if n:
+                self._rebalancing = self.loop.create_task(self._add_senders(n))
+
+    async def _add_senders(self, n: int) -> None:
+        added = 0
+        try:
+            for _ in range(n):
+                self.senders.append(await self._create_upload_sender(self.sender_window))
+                added += 1
+                rebalance_stats['added'] += 1
+                # new sender brings its share of window
+                for _ in range(self.sender_window):
+                    self.window.release()
+        except Exception as e:
+            log.debug(f"Adding upload sender failed: {e}")
+        finally:
+            self.grant.shrink(n - added)
+            self._rebalancing = None
+
+    async def _retire_sender(self, sender: UploadSender) -> None:
+        healthy = False
+        try:
+            await sender.retire()
+            healthy = sender.error is None
+            rebalance_stats['retired'] += 1
+        finally:
+            _record_upload_sender(sender.stats())
+            self.pool.release(self.dc_id, sender.sender, healthy=healthy)
+            self.grant.shrink(1)
+            self._rebalancing = None
+
+    def sender_failed(self, e: BaseException) -> None:
+        if all(sender.error is not None for sender in self.senders):
+            self.error = e
+            self.failed.set()
+            # wakes upload waiting for window
+            self.window.release()
+
+    def _create_sender(self) -> Awaitable[MTProtoSender]:
+        return self.pool.acquire(self.dc_id)
 
     async def init_upload(self, file_id: int, file_size: int, part_size_kb: Optional[float] = None,
-                          connection_count: Optional[int] = None, max_connection=None) -> Tuple[int, int, bool]:
+                          connection_count: Optional[int] = None, max_connection=None,
+                          window: int = TG_UPLOAD_WINDOW) -> Tuple[int, int, bool]:
         connection_count = connection_count or self._get_connection_count(file_size, max_count=max_connection)
         print("init_upload count is ", connection_count)
-        part_size = (part_size_kb or utils.get_appropriated_part_size(file_size)) * 1024
+        part_size = int((part_size_kb * 1024) if part_size_kb else upload_part_size(file_size))
         part_count = (file_size + part_size - 1) // part_size
         is_large = file_size > 10 * 1024 * 1024
-        await self._init_upload(connection_count, file_id, part_count, is_large)
+        await self._init_upload(connection_count, file_id, part_count, part_size, is_large, max(window, 1))
         return part_size, part_count, is_large
 
-    async def upload(self, part: bytes) -> None:
-        await self.senders[self.upload_ticker].next(part)
-        self.upload_ticker = (self.upload_ticker + 1) % len(self.senders)
+    async def upload(self, part: memoryview, buf: Optional[bytearray] = None) -> None:
+        # buf is returned to part buffers after part is sent
+        if self.error is None:
+            await self.window.acquire()
+        if self.error is not None:
+            raise self.error
+        self.parts.put_nowait((self.next_part, part, buf))
+        self.next_part += 1
+        self._rebalance()
 
     async def finish_upload(self) -> None:
+        sent = self.loop.create_task(self.parts.join())
+        failed = self.loop.create_task(self.failed.wait())
+        await asyncio.wait([sent, failed], return_when=asyncio.FIRST_COMPLETED)
+        sent.cancel()
+        failed.cancel()
+        if self.error is not None:
+            raise self.error
         await self._cleanup()
 
     async def download(self, file: TypeLocation, file_size: int,
@@ -216,22 +663,57 @@ class ParallelTransferrer:
         await self._init_download(connection_count, file, part_count, part_size)
 
         part = 0
-        while part < part_count:
-            tasks = []
-            for sender in self.senders:
-                tasks.append(self.loop.create_task(sender.next()))
-            for task in tasks:
-                data = await task
-                if not data:
-                    break
-                yield data
-                part += 1
-                log.debug(f"Part {part} downloaded")
+        try:
+            while part < part_count:
+                tasks = []
+                for sender in self.senders:
+                    tasks.append(self.loop.create_task(sender.next()))
+                for task in tasks:
+                    data = await task
+                    if not data:
+                        break
+                    yield data
+                    part += 1
+                    log.debug(f"Part {part} downloaded")
+        except BaseException:
+            await self.abort()
+            raise
 
         log.debug("Parallel download finished, cleaning up connections")
         await self._cleanup()
 
 
+upload_sender_stats = deque(maxlen=200)
+upload_buffer_peaks = deque(maxlen=200)
+# senders added to and retired from running uploads
+rebalance_stats = {'added': 0, 'retired': 0}
+
+
+def _record_upload_sender(stats: dict) -> None:
+    if stats['parts']:
+        upload_sender_stats.append(stats)
+
+
+def transfer_stats() -> dict:
+    throughput = sorted(s['throughput'] for s in upload_sender_stats)
+    return {
+        'window': TG_UPLOAD_WINDOW,
+        'senders': len(throughput),
+        'senders_added': rebalance_stats['added'],
+        'senders_retired': rebalance_stats['retired'],
+        'failed': len([s for s in upload_sender_stats if s['failed']]),
+        'throughput_avg': sum(throughput) / len(throughput) if throughput else 0,
+        'throughput_p5': throughput[int(len(throughput) * 0.05)] if throughput else 0,
+        'throughput_max': throughput[-1] if throughput else 0,
+        'latency_avg': (sum(s['latency_avg'] for s in upload_sender_stats) / len(upload_sender_stats)
+                        if upload_sender_stats else 0),
+        # memory held by parts of running uploads and peak per finished upload
+        'buffers_bytes': sum(b.allocated_bytes for b in active_part_buffers),
+        'buffers_peak_avg': sum(upload_buffer_peaks) / len(upload_buffer_peaks) if upload_buffer_peaks else 0,
+        'buffers_peak_max': max(upload_buffer_peaks) if upload_buffer_peaks else 0
+    }
+
+
 parallel_transfer_locks: DefaultDict[int, asyncio.Lock] = defaultdict(lambda: asyncio.Lock())
 
 
@@ -240,55 +722,43 @@ async def _internal_transfer_to_telegram(client: TelegramClient,
                                          file_size,
                                          file_name,
                                          progress_callback: callable,
-                                         max_connection=None
+                                         max_connection=None,
+                                         checkpoint=None,
+                                         grant=None
                                          ) -> Tuple[TypeInputFile, int]:
-    file_id = helpers.generate_random_long()
+    # checkpoint continues upload of big file, source must be already positioned at its first part
+    if checkpoint is not None and checkpoint.file_id is not None:
+        file_id = checkpoint.file_id
+    else:
+        file_id = helpers.generate_random_long()
     # file_size = os.path.getsize(response.name)
 
     hash_md5 = hashlib.md5()
-    uploader = ParallelTransferrer(client)
-    part_size, part_count, is_large = await uploader.init_upload(file_id, file_size, max_connection=max_connection)
-    buffer = bytearray()
-    part_index = 0
-    async for data in stream_file(response, chunk_size=part_size):
-        part_index += 1
-        if len(data) == 0:
-            part_index -= 1
-            break
-        # if len(data) != part_size and part_index != part_count:
-        #     dat = b'\0' * (part_size - len(data))
-        #     data += dat
-        if not is_large:
-            hash_md5.update(data)
-        if len(buffer) == 0:
-            await uploader.upload(data)
-            if part_index >= part_count:
+    uploader = ParallelTransferrer(client, grant=grant)
+    try:
+        part_size, part_count, is_large = await uploader.init_upload(file_id, file_size, max_connection=max_connection)
+        part_index = 0
+        if checkpoint is not None and is_large:
+            if checkpoint.part_size != part_size:
+                raise ValueError('Checkpoint part size {} differs from {}'.format(checkpoint.part_size, part_size))
+            checkpoint.begin(file_id)
+            uploader.resume(checkpoint)
+            part_index = checkpoint.parts
+        while part_index < part_count:
+            part, buf = await uploader.buffers.read_part(response)
+            if part is None:
                 break
-            else:
-                continue
-        new_len = len(buffer) + len(data)
-        if new_len >= part_size:
-            cutoff = part_size - len(buffer)
-            buffer.extend(data[:cutoff])
-            await uploader.upload(bytes(buffer))
-            buffer.clear()
-            buffer.extend(data[cutoff:])
-        else:
-            buffer.extend(data)
-
-        if part_index >= part_count:
-            break
-        else:
-            continue
-
-    for u in uploader.senders:
-        u.request.file_total_parts = part_index
-        u.part_count = part_index
-    part_count = part_index
-
-    if len(buffer) > 0:
-        await uploader.upload(bytes(buffer))
-    await uploader.finish_upload()
+            part_index += 1
+            if not is_large:
+                hash_md5.update(part)
+            await uploader.upload(part, buf)
+
+        uploader.part_count = part_index
+        part_count = part_index
+        await uploader.finish_upload()
+    except BaseException:
+        await uploader.abort()
+        raise
     if is_large:
         return InputFileBig(file_id, part_count, file_name), file_size
     else:
@@ -320,7 +790,11 @@ async def upload_file(client: TelegramClient,
                                         file_size,
                                         file_name,
                                         progress_callback: callable = None,
-                                        max_connection=None
+                                        max_connection=None,
+                                        checkpoint=None,
+                                        grant=None
                                         ) -> TypeInputFile:
-    res = (await _internal_transfer_to_telegram(client, file, file_size, file_name, progress_callback, max_connection=max_connection))[0]
+    res = (await _internal_transfer_to_telegram(client, file, file_size, file_name, progress_callback,
+                                                max_connection=max_connection, checkpoint=checkpoint,
+                                                grant=grant))[0]
     return res
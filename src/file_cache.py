@@ -0,0 +1,102 @@
+import os
+import sqlite3
+import time
+from telethon.tl.types import InputDocument
+
+
+FILE_CACHE_PATH = os.getenv('FILE_CACHE_PATH', 'file_cache.db')
+FILE_CACHE_TTL = int(os.getenv('FILE_CACHE_TTL', 7 * 24 * 3600))
+FILE_CACHE_SIZE = int(os.getenv('FILE_CACHE_SIZE', 100000))
+
+
+class CachedFile:
+    def __init__(self, file, audio):
+        self.file = file
+        self.audio = audio
+
+
+# maps already delivered media to telegram document reference
+# so the same media can be sent again without downloading and uploading it
+class FileCache:
+    def __init__(self, path=FILE_CACHE_PATH, ttl=FILE_CACHE_TTL, max_size=FILE_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS files ('
+                        'key TEXT PRIMARY KEY, '
+                        'id INTEGER NOT NULL, '
+                        'access_hash INTEGER NOT NULL, '
+                        'file_reference BLOB NOT NULL, '
+                        'audio INTEGER NOT NULL, '
+                        'created REAL NOT NULL, '
+                        'used REAL NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS files_used ON files (used)')
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def get(self, key):
+        if not self.enabled or key is None:
+            return None
+        row = self.db.execute('SELECT id, access_hash, file_reference, audio, created FROM files WHERE key = ?',
+                              (key,)).fetchone()
+        now = time.time()
+        if row is None or now - row[4] > self.ttl:
+            if row is not None:
+                self.invalidate(key)
+            self.misses += 1
+            return None
+        self.db.execute('UPDATE files SET used = ? WHERE key = ?', (now, key))
+        self.hits += 1
+        return CachedFile(InputDocument(row[0], row[1], row[2]), row[3] == 1)
+
+    def put(self, key, media, audio):
+        if not self.enabled or key is None:
+            return
+        document = getattr(media, 'document', None)
+        if document is None or not hasattr(document, 'access_hash'):
+            return
+        now = time.time()
+        self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        (key, document.id, document.access_hash, document.file_reference,
+                         1 if audio else 0, now, now))
+        self._evict(now)
+
+    def invalidate(self, key):
+        self.db.execute('DELETE FROM files WHERE key = ?', (key,))
+
+    def _evict(self, now):
+        self.db.execute('DELETE FROM files WHERE created < ?', (now - self.ttl,))
+        count = self.db.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+        if count > self.max_size:
+            # least recently used entries go first
+            self.db.execute('DELETE FROM files WHERE key IN '
+                            '(SELECT key FROM files ORDER BY used LIMIT ?)', (count - self.max_size,))
+
+    def stats(self):
+        return {
+            'entries': self.db.execute('SELECT COUNT(*) FROM files').fetchone()[0],
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+def media_key(entry, audio_mode, cut_time_range=None, remux=False):
+    extractor = entry.get('extractor_key') or entry.get('extractor')
+    media_id = entry.get('id')
+    if extractor is None or media_id is None:
+        return None
+    cut = ''
+    if cut_time_range is not None:
+        start, end = cut_time_range
+        cut = start.isoformat() + '-' + (end.isoformat() if end is not None else '')
+    return '|'.join([str(extractor),
+                     str(media_id),
+                     str(entry.get('format_id', '')),
+                     'a' if audio_mode else 'v',
+                     cut,
+                     'm' if remux else ''])
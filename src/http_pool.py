@@ -0,0 +1,64 @@
+import os
+from aiohttp import ClientSession, TCPConnector
+
+try:
+    import aiodns
+    from aiohttp.resolver import AsyncResolver
+except ImportError:
+    AsyncResolver = None
+
+
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 300))
+HTTP_POOL_PER_HOST = int(os.getenv('HTTP_POOL_PER_HOST', 32))
+# media downloads have their own connections, so long streams don't hold up short probes of the same host
+HTTP_STREAM_POOL_SIZE = int(os.getenv('HTTP_STREAM_POOL_SIZE', 200))
+HTTP_STREAM_PER_HOST = int(os.getenv('HTTP_STREAM_PER_HOST', 32))
+HTTP_DNS_TTL = int(os.getenv('HTTP_DNS_TTL', 300))
+HTTP_KEEPALIVE = int(os.getenv('HTTP_KEEPALIVE', 30))
+
+_sessions = {}
+
+
+def _session(name, limit, limit_per_host):
+    s = _sessions.get(name)
+    if s is None or s.closed:
+        connector = TCPConnector(verify_ssl=False,
+                                 limit=limit,
+                                 limit_per_host=limit_per_host,
+                                 use_dns_cache=True,
+                                 ttl_dns_cache=HTTP_DNS_TTL,
+                                 keepalive_timeout=HTTP_KEEPALIVE,
+                                 resolver=AsyncResolver() if AsyncResolver is not None else None)
+        s = _sessions[name] = ClientSession(connector=connector)
+    return s
+
+
+# shared sessions so connections and resolved addresses are reused between requests,
+# this one is for probes, api and other short requests
+def session():
+    return _session('requests', HTTP_POOL_SIZE, HTTP_POOL_PER_HOST)
+
+
+# media streams and their range requests
+def stream_session():
+    return _session('streams', HTTP_STREAM_POOL_SIZE, HTTP_STREAM_PER_HOST)
+
+
+def stats():
+    result = {}
+    for name, s in _sessions.items():
+        if s.closed:
+            continue
+        connector = s.connector
+        result[name] = {
+            'acquired': len(connector._acquired),
+            'idle': sum(len(c) for c in connector._conns.values()),
+            'hosts': len(connector._conns)
+        }
+    return result
+
+
+async def close(_app=None):
+    for s in list(_sessions.values()):
+        await s.close()
+    _sessions.clear()
@@ -0,0 +1,101 @@
+import asyncio
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+
+
+class SharedMedia:
+    def __init__(self, media, title, audio):
+        self.media = media
+        self.title = title
+        self.audio = audio
+
+
+class Flight:
+    def __init__(self, registry, key):
+        self.registry = registry
+        self.key = key
+        self.leader = True
+        self.followers = 0
+        self._result = asyncio.get_event_loop().create_future()
+
+    async def wait(self):
+        return await asyncio.shield(self._result)
+
+    def publish(self, media, title, audio):
+        if not self._result.done():
+            self._result.set_result(SharedMedia(media, title, audio))
+        self.registry.remove(self)
+
+    def release(self):
+        # followers get None and try to process the job by themselves
+        if not self._result.done():
+            self._result.set_result(None)
+        self.registry.remove(self)
+
+
+class Follower:
+    def __init__(self, flight):
+        self.key = flight.key
+        self.leader = False
+        self._flight = flight
+
+    async def wait(self):
+        return await self._flight.wait()
+
+    def publish(self, media, title, audio):
+        pass
+
+    def release(self):
+        pass
+
+
+# registry of currently processed jobs, identical jobs from
+# other chats are attached to the running one instead of starting new download
+class InFlightRegistry:
+    def __init__(self):
+        self._flights = {}
+        self.coalesced = 0
+
+    def join(self, key):
+        flight = self._flights.get(key)
+        if flight is not None:
+            flight.followers += 1
+            self.coalesced += 1
+            return Follower(flight)
+
+        flight = Flight(self, key)
+        self._flights[key] = flight
+        task = asyncio.current_task()
+        if task is not None:
+            # release in any case even if job crashed or was cancelled
+            task.add_done_callback(lambda _: flight.release())
+        return flight
+
+    def remove(self, flight):
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    def stats(self):
+        return {
+            'in_flight': len(self._flights),
+            'waiting': sum(f.followers for f in self._flights.values()),
+            'coalesced': self.coalesced
+        }
+
+
+def normalize_url(url):
+    parsed = urlparse(url if '://' in url else 'http://' + url)
+    netloc = parsed.netloc.lower()
+    for prefix in ['www.', 'm.']:
+        if netloc.startswith(prefix):
+            netloc = netloc[len(prefix):]
+            break
+    query = sorted((k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True) if not k.startswith('utm_'))
+
+    return urlunparse(('https', netloc, parsed.path.rstrip('/'), parsed.params, urlencode(query), ''))
+
+
+def job_key(url, formats, audio_mode, cut_time_range=None, cmd=None):
+    cut = None
+    if cut_time_range is not None:
+        cut = tuple(t.isoformat() if t is not None else None for t in cut_time_range)
+    return normalize_url(url), tuple(formats), bool(audio_mode), cut, cmd
@@ -0,0 +1,123 @@
+import asyncio
+import json
+import os
+import sqlite3
+import time
+from collections import deque
+
+
+JOB_QUEUE_PATH = os.getenv('JOB_QUEUE_PATH', 'jobs.db')
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 16))
+JOB_TIMEOUT = int(os.getenv('JOB_TIMEOUT', 21600))
+# job interrupted by restart this many times is dropped
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', 3))
+
+
+# persistent queue of telegram updates processed by limited number of workers,
+# update stays in queue until its job is finished so it survives restart
+class JobQueue:
+    def __init__(self, handler, path=JOB_QUEUE_PATH, workers=JOB_WORKERS, timeout=JOB_TIMEOUT):
+        self.handler = handler
+        self.workers = workers
+        self.timeout = timeout
+        self.running = set()
+        self.processed = 0
+        self.duplicates = 0
+        self.timed_out = 0
+        self.paused = False
+        self._wait_time = deque(maxlen=500)
+        self._slots = []
+        self._queued = None
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                        'update_id INTEGER PRIMARY KEY, '
+                        'payload TEXT NOT NULL, '
+                        'running INTEGER NOT NULL, '
+                        'attempts INTEGER NOT NULL, '
+                        'enqueued REAL NOT NULL)')
+
+    def start(self):
+        # jobs of previous process are processed again
+        self.db.execute('UPDATE jobs SET running = 0, attempts = attempts + 1 WHERE running = 1')
+        self.db.execute('DELETE FROM jobs WHERE attempts >= ? OR enqueued < ?',
+                        (JOB_MAX_ATTEMPTS, time.time() - self.timeout))
+        self._queued = asyncio.Event()
+        self._queued.set()
+        loop = asyncio.get_event_loop()
+        self._slots = [loop.create_task(self._run_slot()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for s in self._slots:
+            s.cancel()
+        self._slots = []
+
+    def put(self, update_id, payload):
+        # telegram may deliver the same update again
+        cursor = self.db.execute('INSERT OR IGNORE INTO jobs VALUES (?, ?, 0, 0, ?)',
+                                 (update_id, json.dumps(payload), time.time()))
+        if cursor.rowcount == 0:
+            self.duplicates += 1
+            return False
+        if self._queued is not None:
+            self._queued.set()
+        return True
+
+    def pause(self):
+        # queued jobs wait for next process
+        self.paused = True
+
+    async def join_running(self, timeout=None):
+        if self.running:
+            await asyncio.wait(list(self.running), timeout=timeout)
+
+    def _claim(self):
+        row = self.db.execute('SELECT update_id, payload, enqueued FROM jobs WHERE running = 0 '
+                              'ORDER BY enqueued LIMIT 1').fetchone()
+        if row is None:
+            return None
+        self.db.execute('UPDATE jobs SET running = 1 WHERE update_id = ?', (row[0],))
+        return row
+
+    async def _run_slot(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            job = None if self.paused else self._claim()
+            if job is None:
+                self._queued.clear()
+                await self._queued.wait()
+                continue
+            update_id, payload, enqueued = job
+            self._wait_time.append(time.time() - enqueued)
+            # job runs in its own task, it's cancelled by deadline
+            task = loop.create_task(self.handler(json.loads(payload)))
+            self.running.add(task)
+            try:
+                await asyncio.wait_for(asyncio.shield(task), timeout=self.timeout)
+            except asyncio.TimeoutError:
+                self.timed_out += 1
+                task.cancel()
+            except asyncio.CancelledError:
+                # process is stopping, job stays in queue
+                task.cancel()
+                raise
+            except Exception as e:
+                print(e)
+            finally:
+                self.running.discard(task)
+            self.db.execute('DELETE FROM jobs WHERE update_id = ?', (update_id,))
+            self.processed += 1
+
+    def stats(self):
+        wait_time = sorted(self._wait_time)
+        return {
+            'workers': self.workers,
+            'depth': self.db.execute('SELECT COUNT(*) FROM jobs WHERE running = 0').fetchone()[0],
+            'running': len(self.running),
+            'processed': self.processed,
+            'duplicates': self.duplicates,
+            'timed_out': self.timed_out,
+            'paused': self.paused,
+            'wait_avg': sum(wait_time) / len(wait_time) if wait_time else 0,
+            'wait_p95': wait_time[int(len(wait_time) * 0.95)] if wait_time else 0
+        }
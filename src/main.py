@@ -22,13 +22,22 @@ import io
 import inspect
 import mimetypes
 from datetime import time, timedelta
-from requests.exceptions import HTTPError as CloudantHTTPError
 from urllib.error import HTTPError
 from urllib.parse import urlparse, urlunparse
 import signal
 import functools
 import fast_telethon
 import aiofiles
+import file_cache
+import inflight
+import extract_cache
+import extract_pool
+import http_pool
+import tg_connections
+import storage
+import upload_checkpoints
+import job_queue
+import media_probe
 
 
 def get_client_session():
@@ -81,26 +90,10 @@ async def on_callback(callback):
     data = callback['data']
     user = await users.User.init(from_id)
     log = new_logger(from_id, msg_id)
-    # retry in case of update conflict
-    for _ in range(15):
-        try:
-            await _on_callback(from_id, msg_id, data, user, log)
-        except CloudantHTTPError as e:
-            if e.response.status_code == 409:
-                log.warning('document update conflict, trying sync with db...')
-                try:
-                    await user.sync_with_db()
-                except CloudantHTTPError as e:
-                    if e.response.status_code == 404:
-                        user = await users.User.init(from_id, force_create=True)
-                continue
-            else:
-                log.exception(e)
-                break
-        except Exception as e:
-            log.exception(e)
-            break
-        break
+    try:
+        await _on_callback(from_id, msg_id, data, user, log)
+    except Exception as e:
+        log.exception(e)
 
 
 async def _on_callback(from_id, msg_id, data, user, log):
@@ -141,18 +134,25 @@ async def _on_callback(from_id, msg_id, data, user, log):
     await send_settings(user, from_id, msg_id)
 
 
+def track_job(task):
+    running_jobs.add(task)
+    task.add_done_callback(running_jobs.discard)
+
+
 async def on_message(request):
     try:
         req_data = await request.json()
 
         if 'callback_query' in req_data:
-            asyncio.get_event_loop().create_task(on_callback(req_data['callback_query']))
+            if draining:
+                # telegram redelivers update to restarted process
+                return web.Response(status=503)
+            track_job(asyncio.get_event_loop().create_task(on_callback(req_data['callback_query'])))
             return web.Response(status=200)
 
         message = req_data['message']
-
-        msg_task = asyncio.get_event_loop().create_task(_on_message_task(message))
-        asyncio.get_event_loop().create_task(task_timeout_cancel(msg_task, timemout=21600))
+        # queued message is persisted, so it's accepted while draining too
+        message_jobs.put(req_data['update_id'], message)
     except Exception as e:
         print(e)
         traceback.print_exc()
@@ -160,12 +160,6 @@ async def on_message(request):
     return web.Response(status=200)
 
 
-async def task_timeout_cancel(task, timemout=5):
-    try:
-        await asyncio.wait_for(task, timeout=timemout)
-    except asyncio.TimeoutError:
-        task.cancel()
-
 async def _on_message_task(message):
     try:
         # async with bot.action(message['chat']['id'], 'file'):
@@ -217,7 +211,25 @@ def cmd_from_message(message):
     return cmd
 
 
-async def extract_url_info(ydl, url):
+def _extract_info(url, params):
+    # runs in executor, YoutubeDL is created off the event loop
+    ydl = youtube_dl.YoutubeDL(params=params)
+    return ydl.extract_info(url, download=False,
+                            force_generic_extractor=params.get('force_generic_extractor', False))
+
+
+def _process_video_info(vinfo, params):
+    ydl = youtube_dl.YoutubeDL(params=params)
+    if vinfo.get('_type') == 'playlist':
+        for i, e in enumerate(vinfo['entries']):
+            e['requested_formats'] = None
+            vinfo['entries'][i] = ydl.process_video_result(e, download=False)
+        return vinfo
+    vinfo['requested_formats'] = None
+    return ydl.process_video_result(vinfo, download=False)
+
+
+async def extract_url_info(params, url):
     # data = {
     #     "url": url,
     #     **params
@@ -228,12 +240,24 @@ async def extract_url_info(ydl, url):
     # async with ClientSession() as session:
     #     async with session.post(YTDL_LAMBDA_URL, json=data, headers=headers, timeout=14400) as req:
     #         return await req.json()
-    return await asyncio.get_event_loop().run_in_executor(None,
-                                                          functools.partial(ydl.extract_info,
-                                                                            download=False,
-                                                                            force_generic_extractor=ydl.params.get(
-                                                                                'force_generic_extractor', False)),
-                                                          url)
+    info = extract_cache.get(url, params)
+    if info is not None:
+        return info
+    try:
+        if extractors.enabled:
+            info = await extractors.extract(url, params)
+        else:
+            info = await asyncio.get_event_loop().run_in_executor(None, _extract_info, url, dict(params))
+    except youtube_dl.DownloadError as e:
+        extract_cache.put_error(url, params, e)
+        raise
+    extract_cache.put(url, params, info)
+    return info
+
+
+async def reprocess_video_info(params, vinfo):
+    # format selection of already extracted info with new format
+    return await asyncio.get_event_loop().run_in_executor(None, _process_video_info, vinfo, dict(params))
 
 
 async def send_settings(user, user_id, edit_id=None):
@@ -290,6 +314,73 @@ async def send_screenshot(user_id, msg_txt, url, http_headers=None):
     await client.send_file(user_id, photo, attributes=[DocumentAttributeFilename("default.jpg")])
 
 
+def media_caption(user, entry, audio_mode):
+    if (user.default_media_type == users.DefaultMediaType.Video.value
+            and user.video_caption and audio_mode == False) or \
+            (((user.default_media_type == users.DefaultMediaType.Audio.value) or
+              (audio_mode == True))
+             and user.audio_caption):
+        return entry['title']
+    return ''
+
+
+# returns storage reservation and name of file for staging media or (None, None) if media must be piped
+async def reserve_storage(size, chat_id, msg_id, title, ext):
+    if not size:
+        return None, None
+    reservation = await local_storage.reserve(size)
+    if reservation is None:
+        return None, None
+    return reservation, str(chat_id) + ':' + str(msg_id) + ':' + title + '.' + ext
+
+
+# returns checkpoint of big file upload, source is moved to first part which wasn't uploaded yet,
+# checkpoint is owned by the job until it's closed
+async def open_upload_checkpoint(key, source, file_size, log):
+    if key is None or not uploads_progress.enabled or not isinstance(source, av_source.URLav) or \
+            not source.resumable(file_size):
+        return None
+    checkpoint = uploads_progress.open(key, file_size, source.validator, fast_telethon.upload_part_size(file_size))
+    if checkpoint is None:
+        log.info('upload checkpoint is used by another job')
+        return None
+    if checkpoint.parts > 0:
+        try:
+            await source.resume_at(checkpoint.parts * checkpoint.part_size)
+            uploads_progress.resuming(checkpoint)
+        except Exception as e:
+            log.warning(e)
+            checkpoint.reset()
+        except BaseException:
+            checkpoint.close()
+            raise
+    return checkpoint
+
+
+# returns flight to lead or None if media was delivered by identical in-flight job
+async def join_inflight_job(key, chat_id, user, log):
+    while True:
+        flight = inflight_jobs.join(key)
+        if flight.leader:
+            return flight
+        log.info('attached to identical in-flight job')
+        shared = await flight.wait()
+        if shared is None:
+            # leading job failed, try again by ourselves
+            continue
+        try:
+            await client.send_file(chat_id, shared.media, caption=media_caption(user,
+                                                                               {'title': shared.title},
+                                                                               shared.audio))
+            return None
+        except AuthKeyDuplicatedError as e:
+            await client.send_message(chat_id, 'INTERNAL ERROR: try again')
+            log.fatal(e)
+            os.abort()
+        except Exception as e:
+            log.warning('failed send shared file: ' + str(e))
+
+
 def normalize_url_path(url):
     parsed = list(urlparse(url))
     parsed[2] = re.sub("/{2,}", "/", parsed[2])
@@ -308,22 +399,30 @@ def youtube_to_invidio(url, audio=False):
                 u += '&listen=1'
     return u
 
-async def upload_multipart_zip(source, name, file_size, chat_id, msg_id):
+def upload_priority(user):
+    return tg_connections.PRIORITY_DONATOR if user.donator else tg_connections.PRIORITY_FREE
+
+
+async def upload_multipart_zip(source, name, file_size, chat_id, msg_id, priority=tg_connections.PRIORITY_FREE):
     zfile = zip_file.ZipTorrentContentFile(source, name, file_size)
 
     async def upload_torrent_content(file, chat_id, msg_id):
-        global TG_CONNECTIONS_COUNT
-        global TG_MAX_PARALLEL_CONNECTIONS
-        if 20 > TG_CONNECTIONS_COUNT and file.size > 100 * 1024 * 1024:
-            TG_CONNECTIONS_COUNT += 2
-            try:
+        grant = None
+        if file.size > 20 * 1024 * 1024:
+            big_file = file.size > 100 * 1024 * 1024
+            grant = await tg_connections.allocator.acquire(chat_id,
+                                                           4 if big_file else 2,
+                                                           minimum=2,
+                                                           priority=priority,
+                                                           timeout=tg_connections.TG_CONNECTIONS_WAIT if big_file else 0)
+        if grant is not None:
+            async with grant:
                 uploaded_file = await fast_telethon.upload_file(client,
                                                                 file,
                                                                 file_size=file.size,
                                                                 file_name=file.name,
-                                                                max_connection=2)
-            finally:
-                TG_CONNECTIONS_COUNT -= 2
+                                                                max_connection=grant.count,
+                                                                grant=grant)
         else:
             uploaded_file = await client.upload_file(file, file_size=file.size, file_name=file.name)
         for i in range(3):
@@ -339,8 +438,11 @@ async def upload_multipart_zip(source, name, file_size, chat_id, msg_id):
 
     try:
         for i in range(0, zfile.zip_parts):
+            if zfile.is_finished:
+                # source of unknown size ended
+                break
             await upload_torrent_content(zfile, chat_id, msg_id)
-            zfile.zip_num += 1
+            zfile.next_part()
     except BadRequestError as e:
         logging.error(e)
 
@@ -363,7 +465,6 @@ async def upload_multipart_zip(source, name, file_size, chat_id, msg_id):
 
 
 async def _on_message(message, log):
-    global STORAGE_SIZE
     if message['from']['is_bot']:
         log.info('Message from bot, skip')
         return
@@ -528,7 +629,20 @@ async def _on_message(message, log):
     #     urls = await ytb_playlist_to_invidious(urls[0], (playlist_start,playlist_end))
     async with client.action(chat_id, "file"):
         urls = set(urls)
+        flight = None
         for iu, u in enumerate(urls):
+            if flight is not None:
+                flight.release()
+                flight = None
+            if playlist_start is None and cmd not in ['s', 't', 'z']:
+                job_key = inflight.job_key(u,
+                                           preferred_formats,
+                                           audio_mode,
+                                           (cut_time_start, cut_time_end) if cut_time_start else None,
+                                           cmd)
+                flight = await join_inflight_job(job_key, chat_id, user, log)
+                if flight is None:
+                    continue
             vinfo = None
             params = {'noplaylist': True,
                       'youtube_include_dash_manifest': False,
@@ -548,18 +662,16 @@ async def _on_message(message, log):
             else:
                 params['playlist_items'] = '1'
 
-            ydl = youtube_dl.YoutubeDL(params=params)
             recover_playlist_index = None  # to save last playlist position if finding format failed
             for ip, pref_format in enumerate(preferred_formats):
                 try:
                     params['format'] = pref_format
                     if recover_playlist_index is not None and 'playliststart' in params:
                         params['playliststart'] += recover_playlist_index
-                    ydl.params = params
                     if vinfo is None:
                         for _ in range(2):
                             try:
-                                vinfo = await extract_url_info(ydl, u)
+                                vinfo = await extract_url_info(params, u)
                                 if vinfo.get('age_limit') == 18 and is_ytb_link_re.search(vinfo.get('webpage_url', '')):
                                     raise youtube_dl.DownloadError('youtube age limit')
                             except youtube_dl.DownloadError as e:
@@ -571,7 +683,7 @@ async def _on_message(message, log):
                                     invid_url = youtube_to_invidio(u, audio_mode == True)
                                     if invid_url:
                                         u = invid_url
-                                        ydl.params['force_generic_extractor'] = True
+                                        params['force_generic_extractor'] = True
                                         continue
                                     raise
                                 else:
@@ -581,22 +693,15 @@ async def _on_message(message, log):
 
                         log.debug('video info received')
                     else:
-                        if '_type' in vinfo and vinfo['_type'] == 'playlist':
-                            for i, e in enumerate(vinfo['entries']):
-                                e['requested_formats'] = None
-                                vinfo['entries'][i] = ydl.process_video_result(e, download=False)
-                        else:
-                            vinfo['requested_formats'] = None
-                            vinfo = ydl.process_video_result(vinfo, download=False)
+                        vinfo = await reprocess_video_info(params, vinfo)
                         log.debug('video info reprocessed with new format')
                 except Exception as e:
                     if "Please log in or sign up to view this video" in str(e):
                         if 'vk.com' in u:
                             params['username'] = os.environ['VIDEO_ACCOUNT_USERNAME']
                             params['password'] = os.environ['VIDEO_ACCOUNT_PASSWORD']
-                            ydl = youtube_dl.YoutubeDL(params=params)
                             try:
-                                vinfo = await extract_url_info(ydl, u)
+                                vinfo = await extract_url_info(params, u)
                             except Exception as e:
                                 log.error(e)
                                 await client.send_message(chat_id, str(e), reply_to=msg_id)
@@ -607,9 +712,8 @@ async def _on_message(message, log):
                             continue
                     elif 'are video-only' in str(e):
                         params['format'] = 'bestvideo[ext=mp4]'
-                        ydl = youtube_dl.YoutubeDL(params=params)
                         try:
-                            vinfo = await extract_url_info(ydl, u)
+                            vinfo = await extract_url_info(params, u)
                         except Exception as e:
                             log.error(e)
                             await client.send_message(chat_id, str(e), reply_to=msg_id)
@@ -639,6 +743,7 @@ async def _on_message(message, log):
                     _file_size = None
                     chosen_format = None
                     ffmpeg_av = None
+                    storage_reservation = None
                     http_headers = None
                     if 'http_headers' not in entry:
                         if formats is not None and 'http_headers' in formats[0]:
@@ -672,6 +777,27 @@ async def _on_message(message, log):
                         return
 
                     _cut_time = (cut_time_start, cut_time_end) if cut_time_start else None
+                    cache_key = None
+                    if cmd != 'z' and not entry.get('is_live'):
+                        cache_key = file_cache.media_key(entry, audio_mode, _cut_time, remux=cmd == 'm')
+                    cached_file = files_cache.get(cache_key)
+                    if cached_file is not None:
+                        try:
+                            await client.send_file(chat_id, cached_file.file,
+                                                   caption=media_caption(user, entry, cached_file.audio))
+                            log.debug('cached file sent')
+                            if flight is not None and len(entries) == 1:
+                                flight.publish(cached_file.file, entry['title'], cached_file.audio)
+                            recover_playlist_index = None
+                            continue
+                        except AuthKeyDuplicatedError as e:
+                            await client.send_message(chat_id, 'INTERNAL ERROR: try again')
+                            log.fatal(e)
+                            os.abort()
+                        except Exception as e:
+                            # file reference is likely expired, upload media again
+                            log.warning('failed send cached file: ' + str(e))
+                            files_cache.invalidate(cache_key)
                     try:
                         if formats is not None:
                             for i, f in enumerate(formats):
@@ -680,7 +806,8 @@ async def _on_message(message, log):
                                     # await bot.send_message(chat_id, "ERROR: Failed find suitable format for: " + entry['title'], reply_to=msg_id)
                                     continue
                                 if 'm3u8' in f['protocol']:
-                                    _file_size = await av_utils.m3u8_video_size(f['url'], http_headers)
+                                    _file_size = await av_utils.m3u8_video_size(f['url'], http_headers, tbr=f.get('tbr'),
+                                                                                exact_limit=TG_MAX_FILE_SIZE)
                                 else:
                                     if 'filesize' in f and f['filesize'] != 0 and f['filesize'] is not None and f[
                                         'filesize'] != 'none':
@@ -733,17 +860,21 @@ async def _on_message(message, log):
                                     _file_size = vsize + msize + 10 * 1024 * 1024
                                     if _file_size < TG_MAX_FILE_SIZE or cut_time_start is not None or cmd == 'z':
                                         file_name = None
-                                        if not cut_time_start and STORAGE_SIZE > _file_size > 0:
-                                            STORAGE_SIZE -= _file_size
+                                        if not cut_time_start and _file_size > 0 and cmd != 'z':
                                             _ext = 'mp4' if audio_mode == False else 'mp3'
-                                            file_name = str(chat_id) + ':' + str(msg_id) + ':' + entry[
-                                                'title'] + '.' + _ext
+                                            storage_reservation, file_name = await reserve_storage(_file_size,
+                                                                                                   chat_id,
+                                                                                                   msg_id,
+                                                                                                   entry['title'],
+                                                                                                   _ext)
                                         ffmpeg_av = await av_source.FFMpegAV.create(vformat,
                                                                                     mformat,
                                                                                     headers=http_headers,
                                                                                     cut_time_range=_cut_time,
                                                                                     file_name=file_name if cmd != 'z' else None,
                                                                                     restrict_size=False if cmd == 'z' else True)
+                                        if storage_reservation is not None:
+                                            storage_reservation.path = ffmpeg_av.file_name
                                         chosen_format = f
                                     break
                                 # m3u8
@@ -767,10 +898,13 @@ async def _on_message(message, log):
                                                 _file_size += msize
 
                                     file_name = None
-                                    if not cut_time_start and STORAGE_SIZE > _file_size > 0:
-                                        STORAGE_SIZE -= _file_size
+                                    if not cut_time_start and _file_size > 0 and cmd != 'z':
                                         _ext = 'mp4' if audio_mode == False else 'mp3'
-                                        file_name = str(chat_id) + ':' + str(msg_id) + ':' + entry['title'] + '.' + _ext
+                                        storage_reservation, file_name = await reserve_storage(_file_size,
+                                                                                               chat_id,
+                                                                                               msg_id,
+                                                                                               entry['title'],
+                                                                                               _ext)
                                     ffmpeg_av = await av_source.FFMpegAV.create(chosen_format,
                                                                                 aformat=mformat,
                                                                                 audio_only=True if audio_mode == True else False,
@@ -778,6 +912,8 @@ async def _on_message(message, log):
                                                                                 cut_time_range=_cut_time,
                                                                                 file_name=file_name if cmd != 'z' else None,
                                                                                 restrict_size=False if cmd == 'z' else True)
+                                    if storage_reservation is not None:
+                                        storage_reservation.path = ffmpeg_av.file_name
                                     break
                                 # regular video stream
                                 if (0 < _file_size <= TG_MAX_FILE_SIZE) or cut_time_start is not None or cmd == 'z':
@@ -804,7 +940,10 @@ async def _on_message(message, log):
                                 break
                             if 'm3u8' in entry['protocol']:
                                 if cut_time_start is None and entry.get('is_live', False) is False and audio_mode == False:
-                                    _file_size = await av_utils.m3u8_video_size(entry['url'], http_headers=http_headers)
+                                    _file_size = await av_utils.m3u8_video_size(entry['url'],
+                                                                                http_headers=http_headers,
+                                                                                tbr=entry.get('tbr'),
+                                                                                exact_limit=TG_MAX_FILE_SIZE)
                                 else:
                                     # we don't know real size
                                     _file_size = 0
@@ -832,16 +971,21 @@ async def _on_message(message, log):
                                                                         time(hour=5, minute=30, second=0))
                                     _cut_time = (cut_time_start, cut_time_end)
                                 file_name = None
-                                if not cut_time_start and STORAGE_SIZE > _file_size > 0:
-                                    STORAGE_SIZE -= _file_size
+                                if not cut_time_start and _file_size > 0 and cmd != 'z':
                                     _ext = 'mp4' if audio_mode == False else 'mp3'
-                                    file_name = str(chat_id) + ':' + str(msg_id) + ':' + entry['title'] + '.' + _ext
+                                    storage_reservation, file_name = await reserve_storage(_file_size,
+                                                                                           chat_id,
+                                                                                           msg_id,
+                                                                                           entry['title'],
+                                                                                           _ext)
                                 ffmpeg_av = await av_source.FFMpegAV.create(chosen_format,
                                                                             audio_only=True if audio_mode == True else False,
                                                                             headers=http_headers,
                                                                             cut_time_range=_cut_time,
                                                                             file_name=file_name if cmd != 'z' else None,
                                                                             restrict_size=False if cmd == 'z' else True)
+                                if storage_reservation is not None:
+                                    storage_reservation.path = ffmpeg_av.file_name
                             elif (_file_size <= TG_MAX_FILE_SIZE) or cut_time_start is not None or cmd == 'z':
                                 chosen_format = entry
                                 direct_url = chosen_format['url']
@@ -870,7 +1014,8 @@ async def _on_message(message, log):
                                                                     parse_mode='html')
                                             return
                                         source = await av_source.URLav.create(entry.get('url'), http_headers)
-                                        await upload_multipart_zip(source, entry['title']+'.'+entry['ext'], _file_size, chat_id, msg_id)
+                                        await upload_multipart_zip(source, entry['title']+'.'+entry['ext'], _file_size, chat_id, msg_id,
+                                                                   priority=upload_priority(user))
                                     else:
                                         await client.send_message(chat_id,
                                                                 f'ERROR: Too big media file size <b>{sizeof_fmt(_file_size)}</b>,\n'
@@ -920,7 +1065,8 @@ async def _on_message(message, log):
                                 http_headers)
                             await upload_multipart_zip(upload_file,
                                                        entry['title'] + '.' + entry['ext'], _file_size, chat_id,
-                                                       msg_id)
+                                                       msg_id,
+                                                       priority=upload_priority(user))
                             return
                         if audio_mode == True and _file_size != 0 and (ffmpeg_av is None or ffmpeg_av.file_name is None):
                             # we don't know real size due to converting formats
@@ -1061,12 +1207,16 @@ async def _on_message(message, log):
                         if cmd == 'm' and chosen_format.get('ext') != 'mp4' and ffmpeg_av is None and (
                                 video_codec == 'h264' or video_codec == 'hevc') and \
                                 (audio_codec == 'mp3' or audio_codec == 'aac'):
-                            file_name = entry.get('title', 'default') + '.mp4'
-                            if STORAGE_SIZE > _file_size > 0:
-                                STORAGE_SIZE -= _file_size
+                            storage_reservation, file_name = await reserve_storage(_file_size,
+                                                                                   chat_id,
+                                                                                   msg_id,
+                                                                                   entry.get('title', 'default'),
+                                                                                   'mp4')
+                            if storage_reservation is not None:
                                 ffmpeg_av = await av_source.FFMpegAV.create(chosen_format,
                                                                             headers=http_headers,
                                                                             file_name=file_name)
+                                storage_reservation.path = ffmpeg_av.file_name
                         upload_file = ffmpeg_av if ffmpeg_av is not None else await av_source.URLav.create(
                             chosen_format['url'],
                             http_headers)
@@ -1088,34 +1238,39 @@ async def _on_message(message, log):
                             if cut_time_start is not None:
                                 cancel_time += duration + 300
                             ffmpeg_cancel_task = asyncio.get_event_loop().call_later(cancel_time, ffmpeg_av.safe_close)
-                        global TG_CONNECTIONS_COUNT
-                        global TG_MAX_PARALLEL_CONNECTIONS
                         try:
                             if ffmpeg_av and ffmpeg_av.file_name:
                                 await ffmpeg_av.stream.wait()
-                                file_size_real = os.path.getsize(ffmpeg_av.file_name)
-                                STORAGE_SIZE += file_size - file_size_real
-                                file_size = file_size_real
+                                file_size = storage_reservation.reconcile()
                                 local_file = aiofiles.open(ffmpeg_av.file_name, mode='rb')
                                 upload_file = await local_file.__aenter__()
                             # uploading piped ffmpeg file is slow anyway
                             # TODO проверка на то что ffmpeg_av имееет file_name
-                            if (file_size > 20 * 1024 * 1024 and TG_CONNECTIONS_COUNT < TG_MAX_PARALLEL_CONNECTIONS) and \
+                            grant = None
+                            if file_size > 20 * 1024 * 1024 and \
                                     (isinstance(upload_file, av_source.URLav) or
                                      isinstance(upload_file, aiofiles.threadpool.binary.AsyncBufferedReader)):
-                                try:
-                                    connections = 2
-                                    if TG_CONNECTIONS_COUNT < 12 and file_size > 100 * 1024 * 1024:
-                                        connections = 4
-
-                                    TG_CONNECTIONS_COUNT += connections
-                                    file = await fast_telethon.upload_file(client,
-                                                                           upload_file,
-                                                                           file_size,
-                                                                           file_name,
-                                                                           max_connection=connections)
-                                finally:
-                                    TG_CONNECTIONS_COUNT -= connections
+                                big_file = file_size > 100 * 1024 * 1024
+                                # big files wait a bit for parallel connections instead of slow single connection upload
+                                grant = await tg_connections.allocator.acquire(chat_id,
+                                                                               4 if big_file else 2,
+                                                                               minimum=2,
+                                                                               priority=upload_priority(user),
+                                                                               timeout=tg_connections.TG_CONNECTIONS_WAIT if big_file else 0)
+                            if grant is not None:
+                                async with grant:
+                                    checkpoint = await open_upload_checkpoint(cache_key, upload_file, file_size, log)
+                                    try:
+                                        file = await fast_telethon.upload_file(client,
+                                                                               upload_file,
+                                                                               file_size,
+                                                                               file_name,
+                                                                               max_connection=grant.count,
+                                                                               checkpoint=checkpoint,
+                                                                               grant=grant)
+                                    finally:
+                                        if checkpoint is not None:
+                                            checkpoint.close()
                             else:
                                 file = await client.upload_file(upload_file,
                                                                 file_name=file_name,
@@ -1132,14 +1287,12 @@ async def _on_message(message, log):
                             raise
                         finally:
                             if ffmpeg_av and ffmpeg_av.file_name:
-                                STORAGE_SIZE += file_size
-                                if STORAGE_SIZE > MAX_STORAGE_SIZE:
-                                    log.warning('logic error, reclaimed storage size bigger then initial')
-                                    STORAGE_SIZE = MAX_STORAGE_SIZE
                                 if isinstance(upload_file, aiofiles.threadpool.binary.AsyncBufferedReader):
                                     await local_file.__aexit__(exc_type=None, exc_val=None, exc_tb=None)
+                            if storage_reservation is not None:
                                 try:
-                                    os.remove(ffmpeg_av.file_name)
+                                    # removes staged file
+                                    storage_reservation.release()
                                 except Exception as e:
                                     log.exception(e)
 
@@ -1176,11 +1329,7 @@ async def _on_message(message, log):
                         video_note = False if audio_mode == True or force_document else True
                         voice_note = True if audio_mode == True else False
                         attributes = ((attributes,) if not force_document else None)
-                        caption = entry['title'] if (user.default_media_type == users.DefaultMediaType.Video.value
-                                                     and user.video_caption and audio_mode == False) or \
-                                                    (((user.default_media_type == users.DefaultMediaType.Audio.value) or
-                                                      (audio_mode == True))
-                                                     and user.audio_caption) else ''
+                        caption = media_caption(user, entry, audio_mode)
                         recover_playlist_index = None
                         _thumb = None
                         try:
@@ -1190,14 +1339,14 @@ async def _on_message(message, log):
 
                         for i in range(3):
                             try:
-                                await client.send_file(chat_id, file,
-                                                       video_note=video_note,
-                                                       voice_note=voice_note,
-                                                       attributes=attributes,
-                                                       caption=caption,
-                                                       force_document=force_document,
-                                                       supports_streaming=False if ffmpeg_av is not None else True,
-                                                       thumb=_thumb)
+                                sent_msg = await client.send_file(chat_id, file,
+                                                                  video_note=video_note,
+                                                                  voice_note=voice_note,
+                                                                  attributes=attributes,
+                                                                  caption=caption,
+                                                                  force_document=force_document,
+                                                                  supports_streaming=False if ffmpeg_av is not None else True,
+                                                                  thumb=_thumb)
                             except AuthKeyDuplicatedError as e:
                                 await client.send_message(chat_id, 'INTERNAL ERROR: try again')
                                 log.fatal(e)
@@ -1209,6 +1358,11 @@ async def _on_message(message, log):
                                 await asyncio.sleep(1*i)
                                 continue
 
+                            files_cache.put(cache_key, sent_msg.media, audio_mode)
+                            if cache_key is not None:
+                                uploads_progress.remove(cache_key)
+                            if flight is not None and len(entries) == 1:
+                                flight.publish(sent_msg.media, entry['title'], audio_mode)
                             break
                     except AuthKeyDuplicatedError as e:
                         await client.send_message(chat_id, 'INTERNAL ERROR: try again')
@@ -1221,6 +1375,9 @@ async def _on_message(message, log):
                         else:
                             log.warning(e)
                             recover_playlist_index = ie
+                    finally:
+                        if storage_reservation is not None:
+                            storage_reservation.release()
 
                 if recover_playlist_index is None:
                     break
@@ -1251,10 +1408,65 @@ playlist_cmds = ['p', 'pa', 'pw']
 available_cmds = ['start', 'ping', 'donate', 'settings', 'a', 'w', 'c', 's', 't', 'm', 'z'] + playlist_cmds
 
 TG_MAX_FILE_SIZE = 2000 * 1024 * 1024
-TG_MAX_PARALLEL_CONNECTIONS = 30
-TG_CONNECTIONS_COUNT = 0
-MAX_STORAGE_SIZE = int(os.getenv('STORAGE_SIZE', 0)) * 1024 * 1024
-STORAGE_SIZE = MAX_STORAGE_SIZE
+local_storage = storage.StorageManager()
+
+files_cache = file_cache.FileCache()
+inflight_jobs = inflight.InFlightRegistry()
+extractors = extract_pool.ExtractPool()
+uploads_progress = upload_checkpoints.UploadCheckpoints()
+message_jobs = job_queue.JobQueue(_on_message_task)
+
+# how long running jobs may finish after youtube-dl update before restart
+RELOAD_DRAIN_TIMEOUT = int(os.getenv('RELOAD_DRAIN_TIMEOUT', 3600))
+running_jobs = set()
+draining = False
+
+
+async def on_stats(request):
+    return web.json_response({
+        'file_cache': files_cache.stats(),
+        'in_flight': inflight_jobs.stats(),
+        'extract_cache': extract_cache.stats(),
+        'extractors': extractors.stats(),
+        'm3u8_probe': av_utils.m3u8_probe_stats,
+        'av_info': av_utils.av_info_cache_stats(),
+        'media_probe': media_probe.stats(),
+        'thumbnails': thumb.stats(),
+        'http_pool': http_pool.stats(),
+        'tg_connections': tg_connections.allocator.stats(),
+        'storage': local_storage.stats(),
+        'tg_senders': fast_telethon.sender_pool(client).stats(),
+        'tg_uploads': fast_telethon.transfer_stats(),
+        'ranged_downloads': av_source.ranged_stats,
+        'url_resume': av_source.resume_stats,
+        'upload_checkpoints': uploads_progress.stats(),
+        'users': users.stats(),
+        'jobs': dict(message_jobs.stats(), callbacks=len(running_jobs), draining=draining)
+    })
+
+
+async def on_health(request):
+    # dispatcher moves chats of draining instance to other ones
+    return web.Response(status=503 if draining else 200)
+
+
+async def start_jobs(_app=None):
+    users.backend.start()
+    message_jobs.start()
+
+
+async def stop_jobs(_app=None):
+    await message_jobs.stop()
+    users.backend.stop()
+
+
+async def start_extractors(_app=None):
+    if extractors.enabled:
+        await extractors.start()
+
+
+async def stop_extractors(_app=None):
+    await extractors.stop()
 
 
 async def shutdown():
@@ -1262,7 +1474,29 @@ async def shutdown():
     sys.exit(1)
 
 
+# called after youtube-dl update
+async def reload():
+    global draining
+    # errors of old version may be fixed
+    extract_cache.errors.clear()
+    if extractors.enabled:
+        # workers import new youtube-dl after their current job, running jobs aren't touched
+        extractors.recycle()
+        return
+    if draining:
+        return
+    draining = True
+    # queued jobs are left for restarted process
+    message_jobs.pause()
+    running = running_jobs | message_jobs.running
+    logging.warning('draining {} jobs before restart'.format(len(running)))
+    if running:
+        await asyncio.wait(list(running), timeout=RELOAD_DRAIN_TIMEOUT)
+    await shutdown()
+
+
 async def tg_client_shutdown(_app=None):
+    await fast_telethon.sender_pool(client).close()
     await client.disconnect()
 
 
@@ -1270,15 +1504,27 @@ def sig_handler():
     asyncio.run_coroutine_threadsafe(shutdown(), asyncio.get_event_loop())
 
 
+def reload_handler():
+    asyncio.run_coroutine_threadsafe(reload(), asyncio.get_event_loop())
+
+
 if __name__ == '__main__':
-    print('Allowed storage size: ', STORAGE_SIZE)
+    print('Allowed storage size: ', local_storage.capacity)
+    print('Removed orphaned staged files: ', local_storage.cleanup_orphans())
     app = web.Application()
-    app.add_routes([web.post('/bot', on_message)])
+    app.add_routes([web.post('/bot', on_message),
+                    web.get('/stats', on_stats),
+                    web.get('/health', on_health)])
     client.start()
     # asyncio.get_event_loop().create_task(bot._run_until_disconnected())
     asyncio.get_event_loop().add_signal_handler(signal.SIGABRT, sig_handler)
     asyncio.get_event_loop().add_signal_handler(signal.SIGTERM, sig_handler)
-    asyncio.get_event_loop().add_signal_handler(signal.SIGHUP, sig_handler)
+    asyncio.get_event_loop().add_signal_handler(signal.SIGHUP, reload_handler)
+    app.on_startup.append(start_extractors)
+    app.on_startup.append(start_jobs)
     app.on_shutdown.append(tg_client_shutdown)
+    app.on_cleanup.append(stop_jobs)
+    app.on_cleanup.append(stop_extractors)
+    app.on_cleanup.append(http_pool.close)
     asyncio.get_event_loop().create_task(web.run_app(app))
     client.run_until_disconnected()
@@ -0,0 +1,438 @@
+import asyncio
+import os
+import struct
+import time
+from aiohttp import ClientError, ClientTimeout
+import http_pool
+
+
+# read container headers by range requests instead of running ffprobe
+MEDIA_PROBE = int(os.getenv('MEDIA_PROBE', 1)) == 1
+MEDIA_PROBE_TIMEOUT = int(os.getenv('MEDIA_PROBE_TIMEOUT', 20))
+HEAD_SIZE = 64 * 1024
+# larger moov is left to ffprobe
+MAX_HEADER_SIZE = 16 * 1024 * 1024
+
+probe_stats = {
+    'parsed': 0,
+    'fallbacks': 0,
+    'bytes_fetched': 0,
+    'latency_total': 0.0
+}
+
+_mp4_codecs = {
+    b'avc1': 'h264', b'avc3': 'h264', b'hev1': 'hevc', b'hvc1': 'hevc', b'av01': 'av1', b'vp09': 'vp9',
+    b'vp08': 'vp8', b'mp4v': 'mpeg4', b'mp4a': 'aac', b'Opus': 'opus', b'ac-3': 'ac3', b'ec-3': 'eac3',
+    b'fLaC': 'flac', b'.mp3': 'mp3'
+}
+_mp4_tags = {b'\xa9nam': 'title', b'\xa9ART': 'artist', b'\xa9alb': 'album'}
+
+_mkv_codecs = {
+    'V_VP8': 'vp8', 'V_VP9': 'vp9', 'V_AV1': 'av1', 'V_MPEG4/ISO/AVC': 'h264', 'V_MPEGH/ISO/HEVC': 'hevc',
+    'A_OPUS': 'opus', 'A_VORBIS': 'vorbis', 'A_AAC': 'aac', 'A_MPEG/L3': 'mp3', 'A_AC3': 'ac3', 'A_EAC3': 'eac3',
+    'A_FLAC': 'flac'
+}
+EBML_MAGIC = b'\x1a\x45\xdf\xa3'
+MKV_SEGMENT = 0x18538067
+MKV_INFO = 0x1549A966
+MKV_TRACKS = 0x1654AE6B
+MKV_CLUSTER = 0x1F43B675
+MKV_TRACK_ENTRY = 0xAE
+MKV_VIDEO = 0xE0
+
+_mp3_bitrates = {
+    1: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]
+}
+_mp3_sample_rates = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+_id3_frames = {'TIT2': 'title', 'TPE1': 'artist', 'TALB': 'album'}
+
+
+class Unsupported(Exception):
+    pass
+
+
+class _RangeReader:
+    def __init__(self, url, headers):
+        self.url = url
+        self.headers = dict(headers) if headers else {}
+        self.size = None
+        self.fetched = 0
+
+    async def read(self, start, length):
+        headers = dict(self.headers)
+        headers['Range'] = 'bytes={}-{}'.format(start, start + length - 1)
+        async with http_pool.session().get(self.url, headers=headers,
+                                           timeout=ClientTimeout(total=MEDIA_PROBE_TIMEOUT)) as resp:
+            if resp.status == 206:
+                total = resp.headers.get('Content-Range', '').rsplit('/', 1)[-1]
+                if total.isdigit():
+                    self.size = int(total)
+            elif resp.status == 200 and start == 0:
+                # whole file is sent, only needed part is read
+                self.size = resp.content_length
+            else:
+                raise Unsupported('range request failed with status {}'.format(resp.status))
+            try:
+                data = await resp.content.readexactly(length)
+            except asyncio.IncompleteReadError as e:
+                data = e.partial
+        self.fetched += len(data)
+        return data
+
+
+async def probe(url, headers=None):
+    # returns ffprobe like info or None if container isn't supported
+    if not MEDIA_PROBE or '.m3u8' in url:
+        return None
+    started = time.monotonic()
+    reader = _RangeReader(url, headers)
+    try:
+        head = await reader.read(0, HEAD_SIZE)
+        if head[4:8] in [b'ftyp', b'moov', b'free', b'mdat', b'wide']:
+            info = await _probe_mp4(reader, head)
+        elif head[:4] == EBML_MAGIC:
+            info = _probe_mkv(head)
+        elif head[:3] == b'ID3' or _mp3_frame(head, 0) is not None:
+            info = await _probe_mp3(reader, head)
+        else:
+            info = None
+    except (Unsupported, ClientError, asyncio.TimeoutError, struct.error, IndexError, ValueError,
+            UnicodeDecodeError) as e:
+        print('media probe failed:', e)
+        info = None
+    probe_stats['bytes_fetched'] += reader.fetched
+    probe_stats['latency_total'] += time.monotonic() - started
+    if info is None:
+        probe_stats['fallbacks'] += 1
+    else:
+        probe_stats['parsed'] += 1
+    return info
+
+
+def _info(streams, duration, format_name, tags):
+    if not streams or not duration or duration <= 0:
+        return None
+    info = {
+        'streams': streams,
+        'format': {
+            'duration': int(duration),
+            'format_name': format_name
+        }
+    }
+    if tags:
+        info['format']['tags'] = tags
+    return info
+
+
+def _boxes(data, start, end):
+    pos = start
+    while pos + 8 <= end:
+        size, kind = struct.unpack_from('>I4s', data, pos)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', data, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header:
+            raise ValueError('bad mp4 box size')
+        yield kind, pos + header, min(pos + size, end)
+        pos += size
+
+
+def _find_box(data, start, end, *path):
+    for kind, body, body_end in _boxes(data, start, end):
+        if kind == path[0]:
+            if len(path) == 1:
+                return body, body_end
+            return _find_box(data, body, body_end, *path[1:])
+    return None
+
+
+async def _probe_mp4(reader, head):
+    # moov is at start of faststart files and after mdat otherwise
+    pos = 0
+    for _ in range(64):
+        if pos + 16 <= len(head):
+            header = head[pos:pos + 16]
+        elif reader.size is not None and pos >= reader.size:
+            return None
+        else:
+            header = await reader.read(pos, 16 if reader.size is None else min(16, reader.size - pos))
+        if len(header) < 8:
+            return None
+        size, kind = struct.unpack_from('>I4s', header)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', header, 8)[0]
+            header_size = 16
+        elif size == 0:
+            if kind != b'moov':
+                return None
+            size = (reader.size or 0) - pos
+        if size < header_size:
+            return None
+        if kind == b'moov':
+            if size > MAX_HEADER_SIZE:
+                return None
+            if pos + size <= len(head):
+                moov = head[pos + header_size:pos + size]
+            else:
+                moov = await reader.read(pos + header_size, size - header_size)
+            return _parse_moov(moov)
+        pos += size
+    return None
+
+
+def _parse_moov(moov):
+    mvhd = _find_box(moov, 0, len(moov), b'mvhd')
+    if mvhd is None:
+        return None
+    body = mvhd[0]
+    if moov[body] == 1:
+        timescale, duration = struct.unpack_from('>IQ', moov, body + 20)
+    else:
+        timescale, duration = struct.unpack_from('>II', moov, body + 12)
+    if duration == 0:
+        # fragmented file keeps duration in movie extends header
+        mehd = _find_box(moov, 0, len(moov), b'mvex', b'mehd')
+        if mehd is not None:
+            fmt = '>Q' if moov[mehd[0]] == 1 else '>I'
+            duration = struct.unpack_from(fmt, moov, mehd[0] + 4)[0]
+    if timescale == 0:
+        return None
+
+    streams = []
+    for kind, body, body_end in _boxes(moov, 0, len(moov)):
+        if kind != b'trak':
+            continue
+        hdlr = _find_box(moov, body, body_end, b'mdia', b'hdlr')
+        stsd = _find_box(moov, body, body_end, b'mdia', b'minf', b'stbl', b'stsd')
+        if hdlr is None or stsd is None:
+            continue
+        handler = moov[hdlr[0] + 8:hdlr[0] + 12]
+        if handler not in [b'vide', b'soun']:
+            continue
+        # first sample entry after version, flags and entry count
+        entry = stsd[0] + 8
+        fourcc = moov[entry + 4:entry + 8]
+        if fourcc in [b'encv', b'enca']:
+            return None
+        codec = _mp4_codecs.get(fourcc)
+        if codec is None:
+            return None
+        if handler == b'vide':
+            width, height = struct.unpack_from('>HH', moov, entry + 8 + 24)
+            streams.append({'codec_name': codec, 'codec_type': 'video', 'width': width, 'height': height})
+        else:
+            streams.append({'codec_name': codec, 'codec_type': 'audio'})
+
+    tags = {}
+    ilst = _find_ilst(moov)
+    if ilst is not None:
+        for kind, body, body_end in _boxes(moov, ilst[0], ilst[1]):
+            name = _mp4_tags.get(kind)
+            data = _find_box(moov, body, body_end, b'data')
+            if name is not None and data is not None:
+                # type and locale precede value
+                tags[name] = moov[data[0] + 8:data[1]].decode('utf-8', 'replace')
+    return _info(streams, duration / timescale, 'mov,mp4,m4a,3gp,3g2,mj2', tags)
+
+
+def _find_ilst(moov):
+    meta = _find_box(moov, 0, len(moov), b'udta', b'meta')
+    if meta is None:
+        return None
+    # iso meta is full box with version and flags, quicktime one isn't
+    start = meta[0] + 4 if moov[meta[0]:meta[0] + 4] == b'\x00\x00\x00\x00' else meta[0]
+    return _find_box(moov, start, meta[1], b'ilst')
+
+
+def _vint(data, pos, marker=False):
+    first = data[pos]
+    if first == 0:
+        raise ValueError('bad ebml vint')
+    length = 9 - first.bit_length()
+    value = first if marker else first & ((1 << (8 - length)) - 1)
+    for b in data[pos + 1:pos + length]:
+        value = (value << 8) | b
+    if pos + length > len(data):
+        raise ValueError('truncated ebml vint')
+    unknown = not marker and value == (1 << (7 * length)) - 1
+    return value, pos + length, unknown
+
+
+def _elements(data, start, end):
+    pos = start
+    while pos < end:
+        element_id, pos, _ = _vint(data, pos, marker=True)
+        size, pos, unknown = _vint(data, pos)
+        element_end = end if unknown else pos + size
+        yield element_id, pos, element_end
+        pos = element_end
+
+
+def _ebml_uint(data, start, end):
+    return int.from_bytes(data[start:end], 'big')
+
+
+def _ebml_float(data, start, end):
+    return struct.unpack('>f' if end - start == 4 else '>d', data[start:end])[0]
+
+
+def _probe_mkv(head):
+    # info and tracks precede clusters, they are within head of usual file
+    segment = None
+    for element_id, start, end in _elements(head, 0, len(head)):
+        if element_id == MKV_SEGMENT:
+            segment = (start, end)
+            break
+    if segment is None:
+        return None
+    timescale = 1000000
+    duration = None
+    tags = {}
+    streams = None
+    for element_id, start, end in _elements(head, segment[0], min(segment[1], len(head))):
+        if element_id == MKV_CLUSTER:
+            break
+        if end > len(head) and element_id in [MKV_INFO, MKV_TRACKS]:
+            return None
+        if element_id == MKV_INFO:
+            for child, c_start, c_end in _elements(head, start, end):
+                if child == 0x2AD7B1:
+                    timescale = _ebml_uint(head, c_start, c_end)
+                elif child == 0x4489:
+                    duration = _ebml_float(head, c_start, c_end)
+                elif child == 0x7BA9:
+                    tags['title'] = head[c_start:c_end].decode('utf-8', 'replace')
+        elif element_id == MKV_TRACKS:
+            streams = _mkv_tracks(head, start, end)
+            if streams is None:
+                return None
+        if duration is not None and streams is not None:
+            break
+    if duration is None or streams is None:
+        return None
+    return _info(streams, duration * timescale / 1000000000, 'matroska,webm', tags)
+
+
+def _mkv_tracks(data, start, end):
+    streams = []
+    for element_id, e_start, e_end in _elements(data, start, end):
+        if element_id != MKV_TRACK_ENTRY:
+            continue
+        track_type = codec_id = width = height = None
+        for child, c_start, c_end in _elements(data, e_start, e_end):
+            if child == 0x83:
+                track_type = _ebml_uint(data, c_start, c_end)
+            elif child == 0x86:
+                codec_id = data[c_start:c_end].decode('ascii').rstrip('\x00')
+            elif child == MKV_VIDEO:
+                for v_child, v_start, v_end in _elements(data, c_start, c_end):
+                    if v_child == 0xB0:
+                        width = _ebml_uint(data, v_start, v_end)
+                    elif v_child == 0xBA:
+                        height = _ebml_uint(data, v_start, v_end)
+        if track_type not in [1, 2]:
+            continue
+        codec = _mkv_codecs.get(codec_id)
+        if codec is None and codec_id is not None and codec_id.startswith('A_AAC'):
+            codec = 'aac'
+        if codec is None:
+            return None
+        if track_type == 1:
+            streams.append({'codec_name': codec, 'codec_type': 'video', 'width': width, 'height': height})
+        else:
+            streams.append({'codec_name': codec, 'codec_type': 'audio'})
+    return streams
+
+
+def _syncsafe(data):
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def _mp3_frame(data, pos):
+    # returns mpeg version, sample rate, bitrate and channel mode of layer III frame header at pos
+    if pos + 4 > len(data) or data[pos] != 0xFF or data[pos + 1] & 0xE0 != 0xE0:
+        return None
+    version = (data[pos + 1] >> 3) & 3
+    layer = (data[pos + 1] >> 1) & 3
+    bitrate_index = data[pos + 2] >> 4
+    rate_index = (data[pos + 2] >> 2) & 3
+    if version == 1 or layer != 1 or bitrate_index in [0, 15] or rate_index == 3:
+        return None
+    bitrate = _mp3_bitrates[1 if version == 3 else 2][bitrate_index] * 1000
+    return version, _mp3_sample_rates[version][rate_index], bitrate, data[pos + 3] >> 6
+
+
+def _id3_text(data):
+    encoding = data[0]
+    if encoding == 1:
+        text = data[1:].decode('utf-16')
+    elif encoding == 2:
+        text = data[1:].decode('utf-16-be')
+    elif encoding == 3:
+        text = data[1:].decode('utf-8')
+    else:
+        text = data[1:].decode('latin-1')
+    return text.strip('\x00')
+
+
+def _id3_tags(data, version, end):
+    tags = {}
+    pos = 10
+    while pos + 10 <= end:
+        frame_id = data[pos:pos + 4]
+        if frame_id[0] == 0:
+            break
+        size = _syncsafe(data[pos + 4:pos + 8]) if version == 4 else struct.unpack_from('>I', data, pos + 4)[0]
+        name = _id3_frames.get(frame_id.decode('latin-1'))
+        if name is not None and size > 0 and pos + 10 + size <= end:
+            tags[name] = _id3_text(data[pos + 10:pos + 10 + size])
+        pos += 10 + size
+    return tags
+
+
+async def _probe_mp3(reader, head):
+    tags = {}
+    audio_start = 0
+    if head[:3] == b'ID3':
+        audio_start = 10 + _syncsafe(head[6:10]) + (10 if head[5] & 0x10 else 0)
+        if head[3] in [3, 4]:
+            # text frames go before pictures, so frames in head are enough
+            tags = _id3_tags(head, head[3], min(audio_start, len(head)))
+    if audio_start + 4096 <= len(head):
+        data = head[audio_start:]
+    else:
+        data = await reader.read(audio_start, 4096)
+    pos = 0
+    while pos < min(len(data), 4096) and _mp3_frame(data, pos) is None:
+        pos += 1
+    frame = _mp3_frame(data, pos)
+    if frame is None:
+        return None
+    version, sample_rate, bitrate, channel_mode = frame
+    samples = 1152 if version == 3 else 576
+    mono = channel_mode == 3
+    if version == 3:
+        side_info = 17 if mono else 32
+    else:
+        side_info = 9 if mono else 17
+    xing = pos + 4 + side_info
+    vbri = pos + 4 + 32
+    if data[xing:xing + 4] in [b'Xing', b'Info'] and struct.unpack_from('>I', data, xing + 4)[0] & 1:
+        duration = struct.unpack_from('>I', data, xing + 8)[0] * samples / sample_rate
+    elif data[vbri:vbri + 4] == b'VBRI':
+        duration = struct.unpack_from('>I', data, vbri + 14)[0] * samples / sample_rate
+    elif reader.size is not None:
+        # constant bitrate
+        duration = (reader.size - audio_start - pos) * 8 / bitrate
+    else:
+        return None
+    return _info([{'codec_name': 'mp3', 'codec_type': 'audio'}], duration, 'mp3', tags)
+
+
+def stats():
+    return dict(probe_stats)
@@ -0,0 +1,133 @@
+import asyncio
+import os
+import re
+
+
+MAX_STORAGE_SIZE = int(os.getenv('STORAGE_SIZE', 0)) * 1024 * 1024
+# how long job waits for free storage before falling back to piped upload
+STORAGE_WAIT = int(os.getenv('STORAGE_WAIT', 60))
+# disk space left for everything else
+STORAGE_FREE_MARGIN = int(os.getenv('STORAGE_FREE_MARGIN', 100)) * 1024 * 1024
+
+# files staged by ffmpeg are named like chat_id:msg_id:title.ext (ffmpeg_av adds quotes)
+staged_file_re = re.compile(r"^'?-?\d+:\d+:.*\.(mp4|mp3)'?$")
+
+
+class Reservation:
+    def __init__(self, manager, size):
+        self.manager = manager
+        self.size = size
+        self.path = None
+
+    def reconcile(self, path=None):
+        # adjust reservation to real size of staged file
+        path = path or self.path
+        actual = os.path.getsize(path)
+        self.manager._adjust(actual - self.size)
+        self.size = actual
+        return actual
+
+    def release(self):
+        if self.manager is None:
+            return
+        self.manager._adjust(-self.size)
+        self.size = 0
+        self.manager = None
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+# accounts local disk space used for staging media files before upload
+class StorageManager:
+    def __init__(self, capacity=MAX_STORAGE_SIZE, directory='.'):
+        self.capacity = capacity
+        self.directory = directory
+        self.reserved = 0
+        self.waiting = 0
+        self.timed_out = 0
+        self._released = None
+
+    @property
+    def enabled(self):
+        return self.capacity > 0
+
+    def disk_free(self):
+        st = os.statvfs(self.directory)
+        return st.f_bavail * st.f_frsize
+
+    def _fits(self, size):
+        return self.reserved + size <= self.capacity and size <= self.disk_free() - STORAGE_FREE_MARGIN
+
+    def _adjust(self, delta):
+        self.reserved = max(self.reserved + delta, 0)
+        if delta < 0 and self._released is not None:
+            self._released.set()
+
+    def try_reserve(self, size):
+        if not self.enabled or size <= 0 or not self._fits(size):
+            return None
+        self.reserved += size
+        return Reservation(self, size)
+
+    async def reserve(self, size, timeout=STORAGE_WAIT):
+        # returns None if storage didn't free up in timeout
+        reservation = self.try_reserve(size)
+        if reservation is not None or not self.enabled or size <= 0 or size > self.capacity:
+            return reservation
+
+        if self._released is None:
+            self._released = asyncio.Event()
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        self.waiting += 1
+        try:
+            while loop.time() < deadline:
+                self._released.clear()
+                try:
+                    # recheck periodically, disk space can be freed by something else
+                    await asyncio.wait_for(self._released.wait(), timeout=min(5, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    pass
+                reservation = self.try_reserve(size)
+                if reservation is not None:
+                    return reservation
+        finally:
+            self.waiting -= 1
+        self.timed_out += 1
+        return None
+
+    def cleanup_orphans(self):
+        # files left by crashed jobs
+        removed = 0
+        for name in os.listdir(self.directory):
+            if staged_file_re.match(name):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                    removed += 1
+                except OSError as e:
+                    print(e)
+        return removed
+
+    def stats(self):
+        return {
+            'capacity': self.capacity,
+            'reserved': self.reserved,
+            'disk_free': self.disk_free(),
+            'waiting': self.waiting,
+            'timed_out': self.timed_out
+        }
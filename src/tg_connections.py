@@ -0,0 +1,180 @@
+import asyncio
+import itertools
+import os
+import time
+from collections import defaultdict
+
+
+TG_MAX_PARALLEL_CONNECTIONS = int(os.getenv('TG_MAX_PARALLEL_CONNECTIONS', 30))
+# single user can't take all connections
+TG_MAX_USER_CONNECTIONS = int(os.getenv('TG_MAX_USER_CONNECTIONS', 8))
+# how long big files wait for parallel upload connections before falling back to single connection upload
+TG_CONNECTIONS_WAIT = int(os.getenv('TG_CONNECTIONS_WAIT', 30))
+# uploads denied connections this long ago still make running uploads give back connections they grew by
+TG_CONNECTIONS_PRESSURE = int(os.getenv('TG_CONNECTIONS_PRESSURE', 30))
+
+PRIORITY_DONATOR = 0
+PRIORITY_FREE = 1
+
+
+class Grant:
+    def __init__(self, allocator, user_id, count):
+        self.allocator = allocator
+        self.user_id = user_id
+        self.count = count
+        # connections taken over the initial grant are given back when others wait
+        self.base = count
+
+    def wanted(self):
+        # connections running upload may add (> 0) or should give back (< 0) right now
+        if self.allocator.contended:
+            return -1 if self.count > self.base else 0
+        return max(self.allocator._available(self.user_id), 0)
+
+    def grow(self, n):
+        # takes up to n more connections if they are free right now
+        n = self.allocator._take(self.user_id, n, 1)
+        self.count += n
+        return n
+
+    def shrink(self, n):
+        n = min(n, self.count)
+        self.count -= n
+        self.allocator._release(self.user_id, n)
+
+    def release(self):
+        self.shrink(self.count)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class _Waiter:
+    def __init__(self, user_id, want, minimum, priority, seq):
+        self.user_id = user_id
+        self.want = want
+        self.minimum = minimum
+        self.priority = priority
+        self.seq = seq
+        self.future = asyncio.get_event_loop().create_future()
+
+
+# shares limited amount of parallel telegram upload connections between users,
+# waiters are served by priority class, then by connections already held by their user
+class ConnectionAllocator:
+    def __init__(self, capacity=TG_MAX_PARALLEL_CONNECTIONS, user_limit=TG_MAX_USER_CONNECTIONS):
+        self.capacity = capacity
+        self.user_limit = user_limit
+        self.used = 0
+        self.granted = 0
+        self.timed_out = 0
+        self.denied = 0
+        self._denied_at = None
+        self._users = defaultdict(int)
+        self._waiters = []
+        self._seq = itertools.count()
+
+    @property
+    def free(self):
+        return self.capacity - self.used
+
+    @property
+    def waiting(self):
+        return len([w for w in self._waiters if not w.future.done()])
+
+    @property
+    def contended(self):
+        # someone waits for connections or was recently denied them
+        return self.waiting > 0 or (self._denied_at is not None and
+                                    time.monotonic() - self._denied_at < TG_CONNECTIONS_PRESSURE)
+
+    def _deny(self):
+        self.denied += 1
+        self._denied_at = time.monotonic()
+
+    def _satisfiable(self, w):
+        return min(w.want, self._available(w.user_id)) >= max(w.minimum, 1)
+
+    def _available(self, user_id):
+        return min(self.free, self.user_limit - self._users.get(user_id, 0))
+
+    def _take(self, user_id, want, minimum):
+        n = min(want, self._available(user_id))
+        if n < minimum or n <= 0:
+            return 0
+        self.used += n
+        self._users[user_id] += n
+        return n
+
+    def _release(self, user_id, n):
+        if n <= 0:
+            return
+        self.used -= n
+        self._users[user_id] -= n
+        if self._users[user_id] <= 0:
+            del self._users[user_id]
+        self._wake()
+
+    def _wake(self):
+        self._waiters = [w for w in self._waiters if not w.future.done()]
+        self._waiters.sort(key=lambda w: (w.priority, self._users.get(w.user_id, 0), w.seq))
+        for w in list(self._waiters):
+            if self.free <= 0:
+                break
+            n = self._take(w.user_id, w.want, w.minimum)
+            if n == 0:
+                continue
+            self._waiters.remove(w)
+            w.future.set_result(Grant(self, w.user_id, n))
+            self.granted += 1
+
+    async def acquire(self, user_id, want, minimum=1, priority=PRIORITY_FREE, timeout=None):
+        # returns None if connections weren't granted in timeout
+        self._wake()
+        # waiters which can't be served now (user limit reached, too few free) don't block others
+        if not any(w.priority <= priority and self._satisfiable(w) for w in self._waiters if not w.future.done()):
+            n = self._take(user_id, want, minimum)
+            if n > 0:
+                self.granted += 1
+                return Grant(self, user_id, n)
+        if timeout is not None and timeout <= 0:
+            self._deny()
+            return None
+
+        waiter = _Waiter(user_id, want, minimum, priority, next(self._seq))
+        self._waiters.append(waiter)
+        try:
+            return await asyncio.wait_for(asyncio.shield(waiter.future), timeout=timeout)
+        except asyncio.TimeoutError:
+            if waiter.future.done():
+                # granted right before timeout
+                return waiter.future.result()
+            self.timed_out += 1
+            self._deny()
+            return None
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                waiter.future.result().release()
+            raise
+        finally:
+            if not waiter.future.done():
+                waiter.future.cancel()
+            self._waiters = [w for w in self._waiters if w is not waiter]
+
+    def stats(self):
+        return {
+            'capacity': self.capacity,
+            'used': self.used,
+            'utilization': self.used / self.capacity if self.capacity else 0,
+            'users': len(self._users),
+            'waiting': self.waiting,
+            'granted': self.granted,
+            'timed_out': self.timed_out,
+            'denied': self.denied
+        }
+
+
+allocator = ConnectionAllocator()
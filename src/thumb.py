@@ -1,29 +1,60 @@
 
-from aiohttp import ClientSession, TCPConnector
+import asyncio
 import io
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 from math import floor
 import av_source
 import av_utils
+import http_pool
+from cache import TTLCache
 from datetime import timedelta
 
+THUMB_WORKERS = int(os.getenv('THUMB_WORKERS', 2))
+THUMB_CACHE_SIZE = int(os.getenv('THUMB_CACHE_SIZE', 512))
+THUMB_CACHE_TTL = int(os.getenv('THUMB_CACHE_TTL', 6 * 3600))
+
+# decoding and encoding images doesn't block event loop which pumps uploads
+resize_pool = ThreadPoolExecutor(max_workers=THUMB_WORKERS, thread_name_prefix='thumb')
+# resized thumbnails by their url
+thumbs = TTLCache(THUMB_CACHE_SIZE, THUMB_CACHE_TTL)
+resize_stats = {
+    'resized': 0,
+    'resize_time': 0.0
+}
+
+
 async def get_thumbnail(thumb_url, entry):
     img_data = None
     if thumb_url is None or thumb_url == 'none':
         img_data = await get_image_from_video(entry['url'], entry['http_headers'])
     else:
-        async with ClientSession(connector=TCPConnector(verify_ssl=False)) as session:
-            async with session.get(thumb_url) as resp:
-                if resp.status != 200:
-                    return None
-                img_data = await resp.read()
-
-    if img_data:
-        thumb = io.BytesIO(img_data)
-        thumb.seek(0)
-        return resize_thumb(thumb)
-    else:
+        cached = thumbs.get(thumb_url)
+        if cached is not None:
+            return io.BytesIO(cached)
+        async with http_pool.session().get(thumb_url) as resp:
+            if resp.status != 200:
+                return None
+            img_data = await resp.read()
+
+    if not img_data:
         return None
+    resized = await asyncio.get_event_loop().run_in_executor(resize_pool, _resize, img_data)
+    if resized is None:
+        return None
+    if thumb_url is not None and thumb_url != 'none':
+        thumbs.set(thumb_url, resized)
+    return io.BytesIO(resized)
+
+
+def _resize(img_data):
+    started = time.monotonic()
+    thumb = resize_thumb(io.BytesIO(img_data))
+    resize_stats['resized'] += 1
+    resize_stats['resize_time'] += time.monotonic() - started
+    return thumb.getvalue() if thumb is not None else None
 
 
 def resize_thumb(thumb):
@@ -43,7 +74,11 @@ def resize_thumb(thumb):
         n_height = 320
         n_width = floor(n_height / (height / width))
 
+    # jpeg is decoded right at reduced scale
+    image.draft('RGB', (n_width, n_height))
     image.thumbnail((n_width, n_height))
+    if image.mode not in ['RGB', 'L']:
+        image = image.convert('RGB')
     new_image = io.BytesIO()
     image.save(new_image, format="JPEG", quality=99)
     new_image.seek(0)
@@ -63,3 +98,7 @@ async def get_image_from_video(url, headers=None):
     return await av_source.video_screenshot(url, headers, screen_time=time)
 
 
+def stats():
+    return dict(thumbs.stats(), **resize_stats)
+
+
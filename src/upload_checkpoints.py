@@ -0,0 +1,111 @@
+import os
+import sqlite3
+import time
+
+
+UPLOAD_CHECKPOINTS_PATH = os.getenv('UPLOAD_CHECKPOINTS_PATH', 'upload_checkpoints.db')
+# telegram keeps uploaded parts of unfinished file for limited time
+UPLOAD_CHECKPOINT_TTL = int(os.getenv('UPLOAD_CHECKPOINT_TTL', 6 * 3600))
+UPLOAD_CHECKPOINT_INTERVAL = float(os.getenv('UPLOAD_CHECKPOINT_INTERVAL', 2))
+
+
+class Checkpoint:
+    def __init__(self, store, key, file_size, validator, part_size, file_id=None, parts=0):
+        self.store = store
+        self.key = key
+        self.file_size = file_size
+        self.validator = validator
+        self.part_size = part_size
+        self.file_id = file_id
+        # parts acknowledged by telegram without gaps
+        self.parts = parts
+        self._saved = 0
+
+    def begin(self, file_id):
+        self.file_id = file_id
+        self.store._save(self)
+        self._saved = time.monotonic()
+
+    def acked(self, parts):
+        self.parts = parts
+        now = time.monotonic()
+        if now - self._saved >= UPLOAD_CHECKPOINT_INTERVAL:
+            self.store._save(self)
+            self._saved = now
+
+    def reset(self):
+        self.file_id = None
+        self.parts = 0
+        self.store.remove(self.key)
+
+    def close(self):
+        self.store._release(self.key)
+
+
+# progress of big file uploads, upload of the same media continues from last
+# acknowledged part after restart
+class UploadCheckpoints:
+    def __init__(self, path=UPLOAD_CHECKPOINTS_PATH, ttl=UPLOAD_CHECKPOINT_TTL):
+        self.ttl = ttl
+        self.resumed = 0
+        self.resumed_parts = 0
+        self.busy = 0
+        # keys of checkpoints used by running uploads
+        self._owned = set()
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS checkpoints ('
+                        'key TEXT PRIMARY KEY, '
+                        'file_id INTEGER NOT NULL, '
+                        'part_size INTEGER NOT NULL, '
+                        'file_size INTEGER NOT NULL, '
+                        'validator TEXT NOT NULL, '
+                        'parts INTEGER NOT NULL, '
+                        'created REAL NOT NULL)')
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def open(self, key, file_size, validator, part_size):
+        # returns None while another upload of the same media owns the checkpoint
+        if key in self._owned:
+            self.busy += 1
+            return None
+        self._owned.add(key)
+        now = time.time()
+        self.db.execute('DELETE FROM checkpoints WHERE created < ?', (now - self.ttl,))
+        row = self.db.execute('SELECT file_id, parts FROM checkpoints '
+                              'WHERE key = ? AND file_size = ? AND validator = ? AND part_size = ?',
+                              (key, file_size, validator, part_size)).fetchone()
+        if row is None:
+            self.remove(key)
+            return Checkpoint(self, key, file_size, validator, part_size)
+        return Checkpoint(self, key, file_size, validator, part_size, file_id=row[0], parts=row[1])
+
+    def resuming(self, checkpoint):
+        self.resumed += 1
+        self.resumed_parts += checkpoint.parts
+
+    def remove(self, key):
+        self.db.execute('DELETE FROM checkpoints WHERE key = ?', (key,))
+
+    def _release(self, key):
+        self._owned.discard(key)
+
+    def _save(self, checkpoint):
+        # created isn't updated, parts expire on telegram side since upload start
+        self.db.execute('INSERT OR IGNORE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        (checkpoint.key, checkpoint.file_id, checkpoint.part_size, checkpoint.file_size,
+                         checkpoint.validator, checkpoint.parts, time.time()))
+        self.db.execute('UPDATE checkpoints SET parts = ? WHERE key = ? AND file_id = ?',
+                        (checkpoint.parts, checkpoint.key, checkpoint.file_id))
+
+    def stats(self):
+        return {
+            'entries': self.db.execute('SELECT COUNT(*) FROM checkpoints').fetchone()[0],
+            'resumed': self.resumed,
+            'resumed_parts': self.resumed_parts,
+            'in_use': len(self._owned),
+            'busy': self.busy
+        }
@@ -1,8 +1,19 @@
-from cloudant.adapters import Replay429Adapter
-from cloudant.client import Cloudant
 import os
 import asyncio
+import time
 from enum import Enum
+import cache
+import couchdb
+
+
+# couchdb (Cloudant) or sqlite
+USERS_BACKEND = os.getenv('USERS_BACKEND', 'couchdb')
+USERS_CACHE_SIZE = int(os.getenv('USERS_CACHE_SIZE', 10000))
+# refetch even if changes feed was silent, in case it missed something
+USERS_CACHE_TTL = int(os.getenv('USERS_CACHE_TTL', 3600))
+USERS_CHANGES_HEARTBEAT = int(os.getenv('USERS_CHANGES_HEARTBEAT', 10))
+# settings changed within this time are saved by one request
+USERS_WRITE_DELAY = float(os.getenv('USERS_WRITE_DELAY', 0.5))
 
 
 class VideoFormat(Enum):
@@ -23,14 +34,9 @@ class User:
     @staticmethod
     async def init(id, force_create=False):
         user = User()
-        user_settings = await get_user(id)
+        user_settings = await backend.get('user' + str(id))
         if user_settings is not None and not force_create:
             user.settings = user_settings
-            change = await get_changes(user.settings['_id'])
-            if change['changes'][-1]['rev'] != user.settings['_rev']:
-                # update doc from _changes request to eliminate reading operation
-                user.settings.update(change['doc'])
-                # await user.sync_with_db()
             if user.banned:
                 raise Exception('You are BANNED!')
             return user
@@ -43,8 +49,7 @@ class User:
             'audio_caption': False,
             'video_caption': False
         }
-        user_settings = await create_user(user_settings)
-        user.settings = user_settings
+        user.settings = await backend.create(user_settings)
 
         return user
 
@@ -53,32 +58,28 @@ class User:
         return self.settings['default_media_type']
 
     async def set_default_media_type(self, m_type):
-        self.settings['default_media_type'] = m_type.value
-        await asyncio.get_event_loop().run_in_executor(None, self.settings.save)
+        self._set('default_media_type', m_type.value)
 
     @property
     def video_format(self):
         return self.settings['video_format']
 
     async def set_video_format(self, vid_format):
-        self.settings['video_format'] = vid_format.value
-        await asyncio.get_event_loop().run_in_executor(None, self.settings.save)
+        self._set('video_format', vid_format.value)
 
     @property
     def audio_caption(self):
         return self.settings['audio_caption']
 
     async def set_audio_caption(self, toggle):
-        self.settings['audio_caption'] = toggle
-        await asyncio.get_event_loop().run_in_executor(None, self.settings.save)
+        self._set('audio_caption', toggle)
 
     @property
     def video_caption(self):
         return self.settings['video_caption']
 
     async def set_video_caption(self, toggle):
-        self.settings['video_caption'] = toggle
-        await asyncio.get_event_loop().run_in_executor(None, self.settings.save)
+        self._set('video_caption', toggle)
 
     @property
     def donator(self):
@@ -89,46 +90,147 @@ class User:
         return self.settings.get('banned', 0) == 1
 
     async def set_donator(self, toggle):
-        self.settings['donator'] = toggle
-        await asyncio.get_event_loop().run_in_executor(None, self.settings.save)
-
-    async def sync_with_db(self):
-        await asyncio.get_event_loop().run_in_executor(None, self.settings.fetch)
-
-
-client = Cloudant(os.environ['CLOUDANT_USERNAME'],
-                  os.environ['CLOUDANT_PASSWORD'],
-                  url=os.environ['CLOUDANT_URL'],
-                  adapter=Replay429Adapter(retries=10),
-                  connect=True)
-db = client['ytbdownbot']
-
-
-async def get_user(id):
-    return await asyncio.get_event_loop().run_in_executor(None, _get_user, id)
+        self._set('donator', toggle)
 
+    def _set(self, key, value):
+        # saved in background together with other changes made meanwhile
+        self.settings[key] = value
+        backend.update(self.settings['_id'], {key: value})
 
-def _get_user(id):
-    user_id = 'user' + str(id)
-    if user_id in db:
-        return db[user_id]
-    else:
-        return None
 
-
-async def create_user(user):
-    return await asyncio.get_event_loop().run_in_executor(None, _create_user, user)
-
-
-def _create_user(user):
-    return db.create_document(user)
-
-
-async def get_changes(doc_id):
-    return await asyncio.get_event_loop().run_in_executor(None, _get_changes, doc_id)
+# users stored in CouchDB/Cloudant, docs are cached and kept fresh by following changes
+class CouchDBUsers:
+    def __init__(self):
+        self.db = couchdb.CouchDB(os.environ['CLOUDANT_URL'], 'ytbdownbot',
+                                  username=os.environ['CLOUDANT_USERNAME'],
+                                  password=os.environ['CLOUDANT_PASSWORD'])
+        self.docs = cache.TTLCache(USERS_CACHE_SIZE, USERS_CACHE_TTL)
+        self.writer = couchdb.DocWriter(self.db, self.docs.peek, USERS_WRITE_DELAY)
+        self.follower = ChangesFollower(self)
+
+    async def get(self, user_id):
+        doc = self.docs.get(user_id)
+        if doc is not None:
+            if not self.follower.alive:
+                # cached doc may be stale while changes aren't followed
+                await self._refresh(doc)
+            return doc
+        doc = await self.db.get(user_id)
+        if doc is not None:
+            self.docs.set(user_id, doc)
+        return doc
+
+    async def _refresh(self, doc):
+        latest = await self.db.get(doc['_id'])
+        if latest is not None and couchdb.rev_num(latest['_rev']) > couchdb.rev_num(doc['_rev']):
+            doc.update(latest)
+            # changes not saved yet stay
+            doc.update(self.writer.pending(doc['_id']))
+
+    async def create(self, doc):
+        doc = await self.db.create(doc)
+        self.docs.set(doc['_id'], doc)
+        return doc
+
+    def update(self, user_id, fields):
+        return self.writer.update(user_id, fields)
+
+    def start(self):
+        self.follower.start()
+
+    def stop(self):
+        self.follower.stop()
+
+    def stats(self):
+        return {
+            'cache': self.docs.stats(),
+            'changes_alive': self.follower.alive,
+            'changes_applied': self.follower.applied,
+            'changes_restarts': self.follower.restarts,
+            'staleness': self.follower.staleness(),
+            'db_requests': self.db.requests,
+            'db_throttled': self.db.throttled,
+            'writes': self.writer.stats()
+        }
 
 
-def _get_changes(doc_id):
-    changes = db.changes(doc_ids=[doc_id], filter='_doc_ids', include_docs=True)
-    for change in changes:
-        return change
+# keeps cached user docs fresh, so ban and donator flags changed in db
+# reach bot without reading the doc on every message
+class ChangesFollower:
+    def __init__(self, users):
+        self.users = users
+        self.alive = False
+        self.applied = 0
+        self.restarts = 0
+        self._since = None
+        self._last_event = None
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_event_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                async for change in self.users.db.follow_changes(since=self._since or 'now',
+                                                                 heartbeat=USERS_CHANGES_HEARTBEAT):
+                    self._on_change(change)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print('users changes feed failed:', e)
+            self._on_failure()
+            await asyncio.sleep(USERS_CHANGES_HEARTBEAT)
+
+    def _on_failure(self):
+        self.alive = False
+        self.restarts += 1
+        if self._since is None:
+            # changes made before feed was started are unknown
+            self.users.docs.clear()
+
+    def _on_change(self, change):
+        self.alive = True
+        self._last_event = time.monotonic()
+        # None is heartbeat
+        if change is None or 'id' not in change:
+            return
+        self._since = change['seq']
+        cached = self.users.docs.peek(change['id'])
+        if cached is None:
+            return
+        if change.get('deleted'):
+            self.users.docs.pop(change['id'])
+            return
+        doc = change.get('doc')
+        # own saves already updated cached doc
+        if doc is not None and couchdb.rev_num(doc['_rev']) > couchdb.rev_num(cached['_rev']):
+            cached.update(doc)
+            # changes not saved yet stay
+            cached.update(self.users.writer.pending(change['id']))
+            self.applied += 1
+
+    def staleness(self):
+        # cached docs reflect db state at least this many seconds old
+        if not self.alive:
+            return None
+        return time.monotonic() - self._last_event
+
+
+def create_backend(name=USERS_BACKEND):
+    if name == 'sqlite':
+        import users_sqlite
+        return users_sqlite.SQLiteUsers()
+    return CouchDBUsers()
+
+
+backend = create_backend()
+
+
+def stats():
+    return dict(backend.stats(), backend=USERS_BACKEND)
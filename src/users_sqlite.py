@@ -0,0 +1,112 @@
+import asyncio
+import os
+import sqlite3
+import sys
+
+
+USERS_DB_PATH = os.getenv('USERS_DB_PATH', 'users.db')
+
+# settings columns and types of their values in user doc
+FIELDS = {
+    'default_media_type': int,
+    'video_format': int,
+    'audio_caption': bool,
+    'video_caption': bool,
+    'donator': int,
+    'banned': int
+}
+
+
+# users stored in local sqlite db, lookups don't leave the process
+class SQLiteUsers:
+    def __init__(self, path=USERS_DB_PATH):
+        self.reads = 0
+        self.writes = 0
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS users ('
+                        'id TEXT PRIMARY KEY, '
+                        'default_media_type INTEGER NOT NULL DEFAULT 0, '
+                        'video_format INTEGER NOT NULL DEFAULT 720, '
+                        'audio_caption INTEGER NOT NULL DEFAULT 0, '
+                        'video_caption INTEGER NOT NULL DEFAULT 0, '
+                        'donator INTEGER NOT NULL DEFAULT 0, '
+                        'banned INTEGER NOT NULL DEFAULT 0)')
+
+    async def get(self, user_id):
+        self.reads += 1
+        row = self.db.execute('SELECT ' + ', '.join(FIELDS) + ' FROM users WHERE id = ?', (user_id,)).fetchone()
+        if row is None:
+            return None
+        doc = {'_id': user_id}
+        for (name, kind), value in zip(FIELDS.items(), row):
+            doc[name] = kind(value)
+        return doc
+
+    async def create(self, doc):
+        self.put(doc)
+        return await self.get(doc['_id'])
+
+    def put(self, doc, replace=False):
+        # missing fields get defaults of the table
+        names = [name for name in FIELDS if doc.get(name) is not None]
+        self.db.execute('INSERT OR {} INTO users (id, {}) VALUES (?{})'.format('REPLACE' if replace else 'IGNORE',
+                                                                             ', '.join(names), ', ?' * len(names)),
+                        [doc['_id']] + [int(doc[name]) for name in names])
+
+    def update(self, user_id, fields):
+        names = [name for name in fields if name in FIELDS]
+        if not names:
+            return
+        self.writes += 1
+        self.db.execute('UPDATE users SET {} WHERE id = ?'.format(', '.join(name + ' = ?' for name in names)),
+                        [int(fields[name]) for name in names] + [user_id])
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def stats(self):
+        return {
+            'entries': self.db.execute('SELECT COUNT(*) FROM users').fetchone()[0],
+            'reads': self.reads,
+            'writes': self.writes
+        }
+
+
+async def import_couchdb(target):
+    # one-shot copy of user docs from ytbdownbot database of Cloudant/CouchDB
+    import couchdb
+    import http_pool
+    source = couchdb.CouchDB(os.environ['CLOUDANT_URL'], 'ytbdownbot',
+                             username=os.environ['CLOUDANT_USERNAME'],
+                             password=os.environ['CLOUDANT_PASSWORD'])
+    imported = 0
+    last_id = None
+    try:
+        while True:
+            docs = await source.list_docs(start_key=last_id)
+            if not docs:
+                break
+            last_id = docs[-1]['_id']
+            target.db.execute('BEGIN')
+            for doc in docs:
+                # there are session docs in the same database
+                if doc['_id'].startswith('user') and 'default_media_type' in doc:
+                    target.put(doc, replace=True)
+                    imported += 1
+            target.db.execute('COMMIT')
+            print('imported {} users'.format(imported))
+    finally:
+        await http_pool.close()
+    return imported
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['import']:
+        print('usage: python3 users_sqlite.py import')
+        sys.exit(1)
+    asyncio.get_event_loop().run_until_complete(import_couchdb(SQLiteUsers()))
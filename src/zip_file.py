@@ -1,8 +1,9 @@
 
+import os
 import typing
 import zipstream
 import math as m
-import time
+from zipfile import ZIP64_LIMIT
 
 
 TG_MAX_FILE_SIZE = 2000*1024*1024
@@ -70,23 +71,39 @@ class Reader(typing.BinaryIO):
         pass
 
 
+# size assumed for media with unknown size, archive is split by TG_MAX_FILE_SIZE until source ends
+UNKNOWN_SIZE = 100 * 1024 * 1024 * 1024
+
+
+def zip_size(name, size):
+    # exact size of STORED archive with single file written by zipstream
+    arcname = os.path.normpath(os.path.splitdrive(name)[1])
+    while arcname[0] in (os.sep, os.altsep):
+        arcname = arcname[1:]
+    null_byte = arcname.find(chr(0))
+    if null_byte >= 0:
+        arcname = arcname[:null_byte]
+    name_len = len(arcname.encode('utf-8'))
+    zip64 = size > ZIP64_LIMIT
+    # local header (sizes are unknown while it's written so it's never zip64), data, data descriptor
+    local_size = 30 + name_len + size + (24 if zip64 else 16)
+    # central directory record with zip64 sizes extra field
+    central_size = 46 + name_len + (20 if zip64 else 0)
+    end_size = 22
+    if local_size > ZIP64_LIMIT:
+        # zip64 end of central directory record and locator
+        end_size += 56 + 20
+    return local_size + central_size + end_size
+
+
 class ZipTorrentContentFile(Reader):
     def __init__(self, file_iter, name, size):
-        self.buf = bytes()
         self.processed_size = 0
-        # self.progress_text = None
-        self.files_size_sum = 0
-        file_names_sum = 0
         self.zipstream = zipstream.ZipFile(mode='w', compression=zipstream.ZIP_STORED, allowZip64=True)
         self.zipstream.write_iter(name, file_iter)
-        self.files_size_sum += size if size != 0 else 100 * 1024 * 1024 * 1024
-        file_names_sum += len(name.encode('utf'))
+        self.real_size = zip_size(name, size) if size else None
 
-        #self.real_size = 21438417 + 205 + 6 #len(files) * (30 + 16 + 46) + 2 * file_names_sum + files_size_sum + 22 + 512
-        self.real_size = (30 + 16 + 46) + 2 * file_names_sum + self.files_size_sum + 22 + 5120
-
-        self.big = self.real_size > TG_MAX_FILE_SIZE
-        self._size = TG_MAX_FILE_SIZE if self.big else self.real_size
+        self.big = self.real_size is None or self.real_size > TG_MAX_FILE_SIZE
 
         last_repl = False
         f_name = ''
@@ -101,25 +118,22 @@ class ZipTorrentContentFile(Reader):
         self._name = f_name
         self.zip_num = 1
         self.must_next_file = False
-        self.zip_parts = m.ceil(self.real_size / TG_MAX_FILE_SIZE)
-        self.downloaded_bytes_count = 0
-        self.last_percent = -1
-        self.should_close = False
+        self.zip_parts = m.ceil((self.real_size or UNKNOWN_SIZE) / TG_MAX_FILE_SIZE)
         self.zipiter = self.zipstream.__aiter__()
         self.is_finished = False
-        self.last_progress_update = time.time()
-
+        # unread rest of last zipstream chunk
+        self._chunk = None
+        self._offset = 0
 
     @property
     def size(self):
-        if self.big:
-            data_left = self.real_size - (self.zip_num - 1) * TG_MAX_FILE_SIZE
-            if data_left > TG_MAX_FILE_SIZE:
-                return TG_MAX_FILE_SIZE
-            else:
-                return data_left
+        if self.real_size is None:
+            return TG_MAX_FILE_SIZE
+        data_left = self.real_size - (self.zip_num - 1) * TG_MAX_FILE_SIZE
+        if data_left > TG_MAX_FILE_SIZE:
+            return TG_MAX_FILE_SIZE
         else:
-            return self._size
+            return data_left
 
     def close(self):
         self.zipstream.close()
@@ -184,55 +198,53 @@ class ZipTorrentContentFile(Reader):
         else:
             return self._name + '.zip'
 
-    async def read(self, n=-1):
-        resp = bytes()
-        if len(self.buf) != 0:
-            resp = self.buf
-            self.buf = bytes()
+    def next_part(self):
+        self.zip_num += 1
+        self.processed_size = 0
+        self.must_next_file = False
+
+    async def _read_views(self, n):
+        # slices of zipstream chunks up to n bytes, never crossing part boundary
+        if self.must_next_file:
+            return []
         if n == -1:
             n = self.size
-        if n + self.processed_size > TG_MAX_FILE_SIZE:
-            n = TG_MAX_FILE_SIZE - self.processed_size
-        elif n + self.processed_size > self.size:
-            n = self.size - self.processed_size
-
-        async for data in self.zipiter:
-            if data is None:
-                break
-            resp += data
-            if not (len(resp) < n and self.processed_size < TG_MAX_FILE_SIZE):
-                break
-
-                #if time.time() - self.last_progress_update > 2:
-                #    await self.event.edit(self.progress_text.format(str(m.floor((self.downloaded_bytes_count*100) / self.size))))
-                #    self.last_progress_update = time.time()
-                #resp += await self.zipstream.__aiter__().__next__()
-                #if len(resp) == 0 and self.should_close == False:
-                #    print("\nSHOULD CLOSE CALL\n")
-                #    self.zipiter = iter(self.zipstream)
-                #    self.should_close = True
-                #    continue
-        if len(resp) > n:
-            self.buf = resp[n:]
-            resp = resp[0:n]
-
-        if len(resp) != 0 and n == 0:
-            # send last piece
-            self.processed_size += len(resp)
-            return resp
-
-        self.processed_size += len(resp)
-
+        n = min(n, self.size - self.processed_size)
+        views = []
+        got = 0
+        while got < n:
+            if self._chunk is None or self._offset >= len(self._chunk):
+                try:
+                    data = await self.zipiter.__anext__()
+                except StopAsyncIteration:
+                    self.is_finished = True
+                    break
+                if data is None:
+                    break
+                self._chunk = memoryview(data)
+                self._offset = 0
+            take = min(n - got, len(self._chunk) - self._offset)
+            views.append(self._chunk[self._offset:self._offset + take])
+            self._offset += take
+            got += take
+
+        self.processed_size += got
         if self.processed_size >= TG_MAX_FILE_SIZE:
-            #if self.is_finished == False and self.real_size - TG_MAX_FILE_SIZE <= 0:
-            #    self.real_size += 1024
-            #    TG_MAX_FILE_SIZE = TG_MAX_FILE_SIZE if self.should_split else self.real_size
-            #    self.big = self.real_size > TG_MAX_FILE_SIZE
-            #    self.size = TG_MAX_FILE_SIZE if self.big else self.real_size
-            #else:
             self.processed_size = 0
             self.must_next_file = True
-            #self.real_size -= TG_MAX_FILE_SIZE
-            # self._size = TG_MAX_FILE_SIZE if self.real_size > TG_MAX_FILE_SIZE else self.real_size
+        return views
 
-        return resp
+    async def read(self, n=-1):
+        views = await self._read_views(n)
+        if len(views) == 1 and len(views[0]) == len(views[0].obj):
+            # whole chunk
+            return views[0].obj
+        return b''.join(views)
+
+    async def readinto(self, buf):
+        view = memoryview(buf).cast('B')
+        filled = 0
+        for v in await self._read_views(len(view)):
+            view[filled:filled + len(v)] = v
+            filled += len(v)
+        return filled
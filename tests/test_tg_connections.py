@@ -0,0 +1,51 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import tg_connections
+
+
+def run(coro):
+    return asyncio.new_event_loop().run_until_complete(coro)
+
+
+def test_capped_user_waiter_does_not_block_fresh_user():
+    async def scenario():
+        allocator = tg_connections.ConnectionAllocator(capacity=30, user_limit=8)
+        capped = await allocator.acquire('capped', 8)
+        assert capped.count == 8
+        # capped user's next big upload can't be served until it releases something
+        waiting = asyncio.ensure_future(allocator.acquire('capped', 4, minimum=2, timeout=10))
+        await asyncio.sleep(0)
+        assert allocator.waiting == 1
+
+        small = await allocator.acquire('fresh', 2, minimum=2, timeout=0)
+        assert small is not None and small.count == 2
+        big = await allocator.acquire('other', 4, minimum=2, timeout=1)
+        assert big is not None and big.count == 4
+        assert not waiting.done()
+
+        capped.release()
+        grant = await waiting
+        assert grant.count == 4
+
+    run(scenario())
+
+
+def test_denied_request_makes_grown_grant_shrink():
+    async def scenario():
+        allocator = tg_connections.ConnectionAllocator(capacity=8, user_limit=8)
+        grant = await allocator.acquire('running', 2, minimum=2)
+        assert grant.wanted() == 6
+        grant.grow(6)
+        assert allocator.free == 0 and grant.wanted() == 0
+
+        assert await allocator.acquire('new', 2, minimum=2, timeout=0) is None
+        assert allocator.contended
+        assert grant.wanted() == -1
+        grant.shrink(6)
+        assert grant.wanted() == 0
+
+    run(scenario())